@@ -2,141 +2,422 @@
 # -*- coding: utf-8 -*-
 """
 데이터 클리닝 및 Train/Val/Test 분할
-- 중복 제거
+- 중복 제거 (완전 중복 + MinHash-LSH 유사 중복)
 - 품질 필터링
 - 전략적 분할
 """
 
-import json
+import argparse
 import hashlib
+import re
+from functools import lru_cache
 from pathlib import Path
 from collections import Counter
+import heapq
+import multiprocessing
 import random
+import sqlite3
+import tempfile
 
-def load_jsonl(file_path):
-    """JSONL 파일 로드"""
-    data = []
-    with open(file_path, 'r', encoding='utf-8') as f:
-        for line in f:
-            try:
-                data.append(json.loads(line.strip()))
-            except:
-                continue
-    return data
+import numpy as np
 
-def save_jsonl(data, file_path):
-    """JSONL 파일 저장"""
-    with open(file_path, 'w', encoding='utf-8') as f:
-        for item in data:
-            f.write(json.dumps(item, ensure_ascii=False) + '\n')
+from cleaning_rules import DEFAULT_RULES_PATH, RuleSet
+from data_profile import LengthProfile
+from jsonl_io import WRITE_BATCH_SIZE, JsonlWriter, dumps, iter_jsonl, load_jsonl, loads, save_jsonl
+from text_normalize import canonical_key
+
+# 해시 분할 버킷 수 (비율 해상도 0.01%)
+SPLIT_BUCKETS = 10000
+
+# MinHash 설정
+MINHASH_PRIME = (1 << 61) - 1
+MINHASH_MAX = (1 << 32) - 1
 
 def get_hash(text):
     """텍스트 해시값 생성"""
     return hashlib.md5(text.encode('utf-8')).hexdigest()
 
-def clean_data(data):
-    """데이터 클리닝"""
-    print("\n" + "="*70)
-    print("데이터 클리닝 시작")
-    print("="*70)
-    
-    original_count = len(data)
-    print(f"\n원본 데이터: {original_count}개")
-    
-    # 1. 중복 제거 (완전 중복)
+def get_fingerprint(text):
+    """중복 인덱스용 64-bit 지문 (hexdigest 문자열보다 메모리가 작음)
+
+    canonical_key 로 정규화한 텍스트를 해시하므로 NFC/NFD, 공백, 끝 문장부호,
+    인사말 접두사만 다른 답변은 같은 지문을 갖는다.
+    """
+    key = canonical_key(text)
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'little', signed=True)
+
+class FingerprintStore:
+    """SQLite 기반 영구 지문 저장소 (증분 클리닝용)
+
+    이전 실행에서 기록한 답변 지문을 디스크에 유지하므로, 새로 추가된
+    배치만 처리해도 기존 train/val/test 와의 중복을 걸러낼 수 있다.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.conn = sqlite3.connect(str(self.path))
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS fingerprints (fp INTEGER PRIMARY KEY) WITHOUT ROWID'
+        )
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM fingerprints').fetchone()[0]
+
+    def __contains__(self, fingerprint):
+        return self.conn.execute('SELECT 1 FROM fingerprints WHERE fp = ?', (fingerprint,)).fetchone() is not None
+
+    def add(self, fingerprint):
+        """새 지문이면 True, 이미 있으면 False (commit() 전까지는 확정되지 않음)"""
+        cursor = self.conn.execute('INSERT OR IGNORE INTO fingerprints VALUES (?)', (fingerprint,))
+        return cursor.rowcount == 1
+
+    def commit(self):
+        self.conn.commit()
+
+    def seed_from_files(self, paths):
+        """기존 분할 파일의 답변 지문 등록 (저장소 최초 생성 시)"""
+        before = len(self)
+        for path in paths:
+            if Path(path).exists():
+                self.conn.executemany(
+                    'INSERT OR IGNORE INTO fingerprints VALUES (?)',
+                    ((get_fingerprint(item['output']),) for item in iter_jsonl(path))
+                )
+        self.conn.commit()
+        return len(self) - before
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# ============================================
+# 유사 중복 탐지 (MinHash + LSH)
+# ============================================
+def get_shingles(text, ngram=3):
+    """문자 n-gram shingle 집합 생성 (공백 정규화, 한국어 음절 단위)"""
+    text = re.sub(r'\s+', ' ', text).strip()
+    if len(text) <= ngram:
+        return {text}
+    return {text[i:i + ngram] for i in range(len(text) - ngram + 1)}
+
+@lru_cache(maxsize=None)
+def _minhash_params(num_perm, seed):
+    """MinHash 순열 계수 (a, b) 생성
+
+    shingle 해시가 32-bit 이고 a, b < 2^32 이므로 a * h + b 가 uint64 를 넘지 않는다.
+    """
+    rng = random.Random(seed)
+    a = np.array([rng.randint(1, MINHASH_MAX) for _ in range(num_perm)], dtype=np.uint64)
+    b = np.array([rng.randint(0, MINHASH_MAX) for _ in range(num_perm)], dtype=np.uint64)
+    return a, b
+
+def minhash_signature(text, num_perm=128, ngram=3, seed=42):
+    """MinHash 시그니처 계산 (uint32 배열, 순열은 NumPy 로 한 번에 계산)"""
+    shingles = get_shingles(text, ngram)
+    hashes = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=4).digest(), 'little') for s in shingles),
+        dtype=np.uint64, count=len(shingles)
+    )
+    a, b = _minhash_params(num_perm, seed)
+    values = (np.outer(hashes, a) + b) % MINHASH_PRIME & MINHASH_MAX
+    return values.min(axis=0).astype(np.uint32)
+
+def choose_lsh_bands(threshold, num_perm):
+    """임계값에 맞는 (band 수, band당 row 수) 선택
+
+    LSH 후보 확률 곡선의 변곡점 (1/b)^(1/r) 이 threshold 에 가장 가까운 조합
+    """
+    best = None
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        error = abs((1 / bands) ** (1 / rows) - threshold)
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+class NearDuplicateIndex:
+    """MinHash-LSH 유사 중복 인덱스
+
+    대표 샘플(먼저 등장한 샘플)의 시그니처만 보관하므로 메모리는
+    전체 코퍼스가 아니라 고유 답변 수에 비례한다. 시그니처는 uint32 배열,
+    band 키는 band 구간 바이트의 해시값(int) 하나로 저장한다.
+    """
+
+    def __init__(self, threshold=0.9, num_perm=128, ngram=3, seed=42):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.ngram = ngram
+        self.seed = seed
+        self.bands, self.rows = choose_lsh_bands(threshold, num_perm)
+        self.buckets = [{} for _ in range(self.bands)]
+        self.signatures = []
+        self.cluster_sizes = Counter()
+
+    def signature(self, text):
+        return minhash_signature(text, self.num_perm, self.ngram, self.seed)
+
+    def add(self, text):
+        """유사 중복이면 대표 샘플 번호를, 새 대표로 등록되면 None 반환"""
+        return self.add_signature(self.signature(text))
+
+    def add_signature(self, sig):
+        """미리 계산한 시그니처로 add() 수행 (병렬 모드에서 워커가 계산)"""
+        keys = [hash(sig[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+
+        checked = set()
+        for band, key in enumerate(keys):
+            for rep in self.buckets[band].get(key, ()):
+                if rep in checked:
+                    continue
+                checked.add(rep)
+                # 후보 쌍 검증: 시그니처 일치율 = 추정 Jaccard 유사도
+                agree = np.count_nonzero(sig == self.signatures[rep])
+                if agree / self.num_perm >= self.threshold:
+                    self.cluster_sizes[rep] += 1
+                    return rep
+
+        rep = len(self.signatures)
+        self.signatures.append(sig)
+        for band, key in enumerate(keys):
+            self.buckets[band].setdefault(key, []).append(rep)
+        return None
+
+    def stats(self):
+        """클러스터 통계"""
+        sizes = [count + 1 for count in self.cluster_sizes.values()]
+        return {
+            'threshold': self.threshold,
+            'bands': self.bands,
+            'rows': self.rows,
+            'clusters': len(sizes),
+            'removed': sum(self.cluster_sizes.values()),
+            'largest_cluster': max(sizes) if sizes else 0,
+            'size_distribution': dict(sorted(Counter(sizes).items())),
+        }
+
+def find_near_duplicates(data, threshold=0.9, num_perm=128, ngram=3, seed=42):
+    """MinHash-LSH 기반 유사 중복 클러스터링
+
+    Returns:
+        keep: 클러스터 대표(가장 먼저 등장한 샘플)만 남긴 데이터
+        stats: 클러스터 통계
+    """
+    index = NearDuplicateIndex(threshold, num_perm, ngram, seed)
+    keep = [item for item in data if index.add(item['output']) is None]
+    return keep, index.stats()
+
+# ============================================
+# 클리닝 파이프라인 (스트리밍)
+# ============================================
+def clean_stream(records, near_dup_threshold=0.9, counts=None, near_dup_index=None, fingerprint_store=None,
+                 rules=None):
+    """레코드 단위 클리닝 제너레이터
+
+    중복 제거 → 유사 중복 제거 → 품질 필터링 + 템플릿 정리(규칙 엔진)를 한 번에 처리한다.
+    메모리는 지문 집합과 유사 중복 인덱스에만 비례한다.
+
+    Args:
+        records: 레코드 iterable
+        near_dup_threshold: 유사 중복 판정 Jaccard 임계값 (None 이면 생략)
+        counts: 단계별 건수를 기록할 Counter (선택)
+        near_dup_index: 외부에서 만든 NearDuplicateIndex (통계 조회용, 선택)
+        fingerprint_store: 영구 FingerprintStore (선택). 지정하면 기존 분할 파일의
+            지문과도 대조하고, 템플릿 정리 후 답변도 함께 대조한다. 조회만 하며
+            지문 등록은 split_stream 이 실제로 기록한 레코드에 대해서만 수행한다.
+        rules: 품질 필터 / 템플릿 정리 RuleSet (기본: config/cleaning_rules.yaml)
+    """
+    if counts is None:
+        counts = Counter()
+    if rules is None:
+        rules = RuleSet.from_yaml()
+    if near_dup_index is None and near_dup_threshold is not None:
+        near_dup_index = NearDuplicateIndex(threshold=near_dup_threshold)
+
     seen_outputs = set()
-    unique_data = []
-    duplicates = 0
-    
-    for item in data:
-        output_hash = get_hash(item['output'])
-        if output_hash not in seen_outputs:
-            seen_outputs.add(output_hash)
-            unique_data.append(item)
-        else:
-            duplicates += 1
-    
-    print(f"  ├─ 완전 중복 제거: {duplicates}개")
-    data = unique_data
-    
-    # 2. 품질 필터링
-    quality_filtered = []
-    
-    for item in data:
-        output = item['output'].strip()
-        instruction = item['instruction'].strip()
-        
-        # 필터링 조건
-        if len(output) < 10:  # 너무 짧은 답변
+    for item in records:
+        counts['input'] += 1
+
+        # 1. 중복 제거 (완전 중복)
+        fingerprint = get_fingerprint(item['output'])
+        if fingerprint in seen_outputs or (fingerprint_store is not None and fingerprint in fingerprint_store):
+            counts['duplicate'] += 1
             continue
-        if len(instruction) < 5:  # 너무 짧은 질문
+        seen_outputs.add(fingerprint)
+
+        # 2. 유사 중복 제거 (MinHash-LSH)
+        if near_dup_index is not None and near_dup_index.add(item['output']) is not None:
+            counts['near_duplicate'] += 1
             continue
-        if output.count('이것이 중요한 이유는') > 1:  # 중복 템플릿
+
+        # 3-4. 품질 필터링 + 템플릿 문구 정리
+        item, rejected_by = rules.process(item)
+        if rejected_by is not None:
+            counts['quality'] += 1
             continue
-        
-        quality_filtered.append(item)
-    
-    removed = len(data) - len(quality_filtered)
-    print(f"  ├─ 품질 필터링: {removed}개 제거")
-    data = quality_filtered
-    
-    # 3. 템플릿 문구 정리
-    cleaned_data = []
-    
-    for item in data:
-        output = item['output']
-        
-        # 과도한 반복 문구 제거
-        if output.count('\n\n이것이 중요한 이유는') == 1:
-            # 템플릿을 더 자연스럽게 변경
-            output = output.replace(
-                '\n\n이것이 중요한 이유는 건강보험 제도와 데이터 분석의 기초가 되기 때문입니다.',
-                ''
-            ).strip()
-        
-        item['output'] = output
-        cleaned_data.append(item)
-    
-    print(f"  └─ 최종 정제 데이터: {len(cleaned_data)}개")
-    
+
+        if fingerprint_store is not None:
+            # 분할 파일에는 정리된 답변이 저장되므로 정리 후 지문도 대조
+            rewritten = get_fingerprint(item['output'])
+            if rewritten != fingerprint:
+                if rewritten in seen_outputs or rewritten in fingerprint_store:
+                    counts['duplicate'] += 1
+                    continue
+                seen_outputs.add(rewritten)
+        counts['output'] += 1
+        yield item
+
+def print_clean_report(counts, near_dup_stats=None, rules=None):
+    """클리닝 단계별 결과 출력"""
+    print(f"\n원본 데이터: {counts['input']}개")
+    print(f"  ├─ 완전 중복 제거: {counts['duplicate']}개")
+    if near_dup_stats is not None:
+        print(f"  ├─ 유사 중복 제거 (Jaccard ≥ {near_dup_stats['threshold']}): {near_dup_stats['removed']}개")
+        print(f"  │    클러스터: {near_dup_stats['clusters']}개, 최대 크기: {near_dup_stats['largest_cluster']}, "
+              f"LSH: {near_dup_stats['bands']} bands × {near_dup_stats['rows']} rows")
+    print(f"  ├─ 품질 필터링: {counts['quality']}개 제거")
+    print(f"  └─ 최종 정제 데이터: {counts['output']}개")
+    if rules is not None:
+        rules.report()
+
+def clean_data(data, near_dup_threshold=0.9, rules=None):
+    """데이터 클리닝
+
+    Args:
+        data: 원본 데이터
+        near_dup_threshold: 유사 중복 판정 Jaccard 임계값 (None 이면 생략)
+        rules: 품질 필터 / 템플릿 정리 RuleSet (기본: config/cleaning_rules.yaml)
+    """
+    print("\n" + "="*70)
+    print("데이터 클리닝 시작")
+    print("="*70)
+
+    counts = Counter()
+    rules = rules if rules is not None else RuleSet.from_yaml()
+    index = NearDuplicateIndex(threshold=near_dup_threshold) if near_dup_threshold is not None else None
+    cleaned_data = list(clean_stream(data, near_dup_threshold, counts, index, rules=rules))
+
+    print_clean_report(counts, index.stats() if index is not None else None, rules)
+
     return cleaned_data
 
+class DataProfile:
+    """한 번의 순회로 누적하는 데이터 통계 (스트리밍용)
+
+    길이 통계는 LengthProfile 의 NumPy 배열로 한 번에 계산한다.
+    """
+
+    def __init__(self):
+        self.lengths = LengthProfile()
+        self.first_words = Counter()
+
+    @property
+    def count(self):
+        return len(self.lengths)
+
+    def update(self, item):
+        self.lengths.update(item)
+
+        words = item['instruction'].split()
+        self.first_words[words[0] if words else ''] += 1
+
+    def track(self, records):
+        """레코드를 그대로 흘려보내며 통계 누적"""
+        for item in records:
+            self.update(item)
+            yield item
+
+    def report(self, title="데이터 분석"):
+        print(f"\n📊 {title}")
+        print(f"  총 샘플 수: {self.count}")
+        if not self.count:
+            return
+
+        # 답변 길이 분석
+        stats = self.lengths.summary('output')
+        print(f"  답변 길이:")
+        print(f"    평균: {stats['mean']:.1f}자")
+        print(f"    최소: {stats['min']}자")
+        print(f"    최대: {stats['max']}자")
+        print(f"    중앙값: {stats['percentiles']['p50']:.0f}자 (p95: {stats['percentiles']['p95']:.0f}자)")
+
+        # 질문 유형 분석
+        print(f"  빈번한 질문 시작어:")
+        for word, count in self.first_words.most_common(5):
+            print(f"    '{word}': {count}개")
+
+    def save_json(self, output_path):
+        """길이 프로파일 JSON 저장 (백분위수, 히스토그램 포함)"""
+        return self.lengths.save_json(output_path)
+
 def analyze_data(data, title="데이터 분석"):
     """데이터 통계 출력"""
-    print(f"\n📊 {title}")
-    print(f"  총 샘플 수: {len(data)}")
-    
-    # 답변 길이 분석
-    output_lengths = [len(item['output']) for item in data]
-    print(f"  답변 길이:")
-    print(f"    평균: {sum(output_lengths)/len(output_lengths):.1f}자")
-    print(f"    최소: {min(output_lengths)}자")
-    print(f"    최대: {max(output_lengths)}자")
-    
-    # 질문 유형 분석
-    instructions = [item['instruction'] for item in data]
-    first_words = [inst.split()[0] if inst.split() else '' for inst in instructions]
-    common_starts = Counter(first_words).most_common(5)
-    print(f"  빈번한 질문 시작어:")
-    for word, count in common_starts:
-        print(f"    '{word}': {count}개")
-
-def split_data(data, train_ratio=0.8, val_ratio=0.1, seed=42):
-    """Train/Val/Test 분할"""
+    profile = DataProfile()
+    for item in data:
+        profile.update(item)
+    profile.report(title)
+    return profile
+
+def split_group_key(item, group_by='output'):
+    """분할 그룹 키 - 같은 키의 레코드는 항상 같은 분할에 배정
+
+    group_by:
+        'output': canonical_key 로 정규화한 답변 (같은 답변의 질문 변형끼리 묶음)
+        'topic': metadata 의 menu/topic (없으면 답변으로 대체)
+    """
+    if group_by == 'topic':
+        metadata = item.get('metadata') or {}
+        if metadata.get('topic'):
+            return f"{metadata.get('menu', '')}/{metadata['topic']}"
+    return canonical_key(item['output'])
+
+def assign_split(item, train_ratio=0.8, val_ratio=0.1, seed=42, group_by='output'):
+    """그룹 키 해시로 분할 결정 (O(1) 메모리, 데이터 추가·병렬 실행에도 결과 고정)"""
+    key = f"{seed}:{split_group_key(item, group_by)}"
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+    bucket = int.from_bytes(digest, 'little') % SPLIT_BUCKETS
+
+    if bucket < train_ratio * SPLIT_BUCKETS:
+        return 'train'
+    if bucket < (train_ratio + val_ratio) * SPLIT_BUCKETS:
+        return 'val'
+    return 'test'
+
+def split_data(data, train_ratio=0.8, val_ratio=0.1, seed=42, group_by=None):
+    """Train/Val/Test 분할
+
+    Args:
+        group_by: None 이면 전체 셔플 후 비율 분할,
+            'output'/'topic' 이면 그룹 키 해시 분할 (누수 방지, 재실행 시 고정)
+    """
     print("\n" + "="*70)
     print("데이터 분할")
     print("="*70)
     
-    random.seed(seed)
-    random.shuffle(data)
-    
     total = len(data)
-    train_size = int(total * train_ratio)
-    val_size = int(total * val_ratio)
     
-    train_data = data[:train_size]
-    val_data = data[train_size:train_size + val_size]
-    test_data = data[train_size + val_size:]
+    if group_by is not None:
+        splits = {'train': [], 'val': [], 'test': []}
+        for item in data:
+            splits[assign_split(item, train_ratio, val_ratio, seed, group_by)].append(item)
+        train_data, val_data, test_data = splits['train'], splits['val'], splits['test']
+    else:
+        random.seed(seed)
+        random.shuffle(data)
+        
+        train_size = int(total * train_ratio)
+        val_size = int(total * val_ratio)
+        
+        train_data = data[:train_size]
+        val_data = data[train_size:train_size + val_size]
+        test_data = data[train_size + val_size:]
     
     print(f"\n분할 결과:")
     print(f"  Train: {len(train_data)}개 ({len(train_data)/total*100:.1f}%)")
@@ -145,28 +426,300 @@ def split_data(data, train_ratio=0.8, val_ratio=0.1, seed=42):
     
     return train_data, val_data, test_data
 
+def split_stream(records, output_dir, train_ratio=0.8, val_ratio=0.1, seed=42, num_samples=3, append=False,
+                 group_by='output', fingerprint_store=None):
+    """스트리밍 Train/Val/Test 분할 - 레코드를 읽는 즉시 분할 파일에 기록
+
+    그룹 키 해시로 배정하므로 같은 답변(또는 주제)의 변형이 여러 분할에
+    흩어지지 않고, append=True 로 이어 써도 기존 배정이 바뀌지 않는다.
+
+    fingerprint_store 를 지정하면 기록한 레코드의 지문을 등록하고, 분할 파일을
+    flush 할 때마다 함께 commit 한다 (중단 후 재실행해도 이미 기록된 레코드는 중복 처리).
+
+    Returns:
+        counts: 분할별 건수
+        samples: 확인용 Train 샘플 (앞 num_samples개)
+    """
+    output_dir = Path(output_dir)
+    counts = Counter()
+    samples = []
+
+    files = {name: JsonlWriter(output_dir / f"{name}.jsonl", append=append)
+             for name in ('train', 'val', 'test')}
+    try:
+        for written, item in enumerate(records, 1):
+            name = assign_split(item, train_ratio, val_ratio, seed, group_by)
+            files[name].write(item)
+            counts[name] += 1
+            if name == 'train' and len(samples) < num_samples:
+                samples.append(item)
+            if fingerprint_store is not None:
+                fingerprint_store.add(get_fingerprint(item['output']))
+                if written % WRITE_BATCH_SIZE == 0:
+                    for f in files.values():
+                        f.flush()
+                    fingerprint_store.commit()
+    finally:
+        for f in files.values():
+            f.close()
+        if fingerprint_store is not None:
+            fingerprint_store.commit()
+
+    return counts, samples
+
+def print_samples(samples):
+    """샘플 출력"""
+    print("\n" + "="*70)
+    print("샘플 데이터 확인")
+    print("="*70)
+
+    for i, item in enumerate(samples, 1):
+        print(f"\n[Train 샘플 {i}]")
+        print(f"Q: {item['instruction']}")
+        print(f"A: {item['output'][:100]}...")
+
+# ============================================
+# 병렬 클리닝 (지문 기준 샤딩)
+# ============================================
+def partition_shards(input_file, shard_dir, num_shards, profile=None):
+    """답변 지문 기준으로 레코드를 샤드 파일에 분배
+
+    같은 답변은 항상 같은 샤드에 들어가므로 샤드 내부 중복 제거만으로
+    전체 완전 중복 제거가 성립한다. 각 줄 앞에 원본 순번을 붙여 병합 순서를 보존한다.
+    """
+    shard_paths = [Path(shard_dir) / f"shard_{i:03d}.jsonl" for i in range(num_shards)]
+    files = [open(path, 'w', encoding='utf-8') for path in shard_paths]
+    try:
+        for idx, item in enumerate(iter_jsonl(input_file)):
+            if profile is not None:
+                profile.update(item)
+            shard = get_fingerprint(item['output']) % num_shards
+            files[shard].write(f"{idx}\t{dumps(item)}\n")
+    finally:
+        for f in files:
+            f.close()
+    return shard_paths
+
+def clean_shard(task):
+    """워커: 샤드 하나의 중복 제거 + 품질 필터링 + 템플릿 정리
+
+    유사 중복 판정은 샤드를 넘나들므로 워커는 시그니처만 계산하고,
+    판정은 병합 단계에서 원본 순서대로 수행한다.
+    """
+    shard_path, out_path, minhash_params, rules = task
+    counts = Counter()
+    seen_outputs = set()
+
+    with open(shard_path, 'r', encoding='utf-8') as fin, open(out_path, 'w', encoding='utf-8') as fout:
+        for line in fin:
+            idx, raw = line.split('\t', 1)
+            item = loads(raw)
+            counts['input'] += 1
+
+            fingerprint = get_fingerprint(item['output'])
+            if fingerprint in seen_outputs:
+                counts['duplicate'] += 1
+                continue
+            seen_outputs.add(fingerprint)
+
+            sig = None
+            if minhash_params is not None:
+                sig = minhash_signature(item['output'], *minhash_params).tolist()
+
+            _, rejected_by = rules.process(item)
+            passed = rejected_by is None
+            if sig is None and not passed:
+                counts['quality'] += 1
+                continue
+
+            fout.write(dumps([int(idx), passed, sig, item]) + '\n')
+
+    return counts, rules.stats()
+
+def merge_shards(paths, counts, near_dup_index=None):
+    """샤드 결과를 원본 순번 기준으로 병합 (결정적 순서)"""
+    def read(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                yield loads(line)
+
+    for idx, passed, sig, item in heapq.merge(*(read(p) for p in paths), key=lambda r: r[0]):
+        if near_dup_index is not None and near_dup_index.add_signature(np.array(sig, dtype=np.uint32)) is not None:
+            counts['near_duplicate'] += 1
+            continue
+        if not passed:
+            counts['quality'] += 1
+            continue
+        counts['output'] += 1
+        yield item
+
+def clean_parallel(input_file, workers, counts, near_dup_index=None, profile=None, work_dir=None, rules=None):
+    """--workers N 모드: 샤드별 프로세스 클리닝 후 결정적 병합
+
+    결과는 단일 프로세스 clean_stream 과 동일하다. 규칙 통계는 워커에서
+    집계되므로 유사 중복으로 빠질 레코드에 대한 필터 적중도 포함된다.
+    """
+    if rules is None:
+        rules = RuleSet.from_yaml()
+    minhash_params = None
+    if near_dup_index is not None:
+        minhash_params = (near_dup_index.num_perm, near_dup_index.ngram, near_dup_index.seed)
+
+    with tempfile.TemporaryDirectory(prefix="clean_shards_", dir=work_dir) as tmp_dir:
+        shard_paths = partition_shards(input_file, tmp_dir, workers, profile)
+        tasks = [(path, path.with_suffix('.clean.jsonl'), minhash_params, rules) for path in shard_paths]
+
+        with multiprocessing.Pool(workers) as pool:
+            for shard_counts, rule_stats in pool.map(clean_shard, tasks):
+                counts.update(shard_counts)
+                rules.merge_stats(rule_stats)
+
+        yield from merge_shards([task[1] for task in tasks], counts, near_dup_index)
+
+def run_stream(input_file, output_dir, near_dup_threshold=0.9, workers=1, fingerprint_store=None, append=False,
+               group_by='output', rules=None):
+    """스트리밍 모드: 읽기 → 클리닝 → 분할 저장을 한 번에 처리"""
+    print(f"\n📂 스트리밍 처리: {input_file}")
+    if fingerprint_store is not None:
+        print(f"  지문 저장소: {fingerprint_store.path} ({len(fingerprint_store):,}건)")
+
+    raw_profile = DataProfile()
+    clean_profile = DataProfile()
+    counts = Counter()
+    rules = rules if rules is not None else RuleSet.from_yaml()
+    index = NearDuplicateIndex(threshold=near_dup_threshold) if near_dup_threshold is not None else None
+
+    if workers > 1:
+        records = clean_parallel(input_file, workers, counts, index, raw_profile, work_dir=output_dir, rules=rules)
+    else:
+        records = raw_profile.track(iter_jsonl(input_file))
+        records = clean_stream(records, near_dup_threshold, counts, index, fingerprint_store, rules)
+    records = clean_profile.track(records)
+    split_counts, samples = split_stream(records, output_dir, append=append, group_by=group_by,
+                                         fingerprint_store=fingerprint_store)
+
+    raw_profile.report("원본 데이터")
+
+    print("\n" + "="*70)
+    print("데이터 클리닝")
+    print("="*70)
+    print_clean_report(counts, index.stats() if index is not None else None, rules)
+    clean_profile.report("정제 데이터")
+    print(f"  ✅ 프로파일: {clean_profile.save_json(Path(output_dir) / 'data_profile.json')}")
+
+    print("\n" + "="*70)
+    print("데이터 분할")
+    print("="*70)
+    total = sum(split_counts.values()) or 1
+    print(f"\n분할 결과:")
+    for name, label in (('train', 'Train:'), ('val', 'Val:  '), ('test', 'Test: ')):
+        print(f"  {label} {split_counts[name]}개 ({split_counts[name]/total*100:.1f}%)")
+        print(f"    ✅ {Path(output_dir) / f'{name}.jsonl'}")
+
+    print_samples(samples)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="HIRA 데이터 클리닝 & 분할")
+    parser.add_argument('--input', type=Path, default=Path("all_data_expanded.jsonl"),
+                        help="입력 JSONL 파일")
+    parser.add_argument('--output-dir', type=Path, default=Path("cleaned_data"),
+                        help="분할 파일 출력 디렉토리")
+    parser.add_argument('--near-dup-threshold', type=float, default=0.9,
+                        help="유사 중복 판정 Jaccard 임계값")
+    parser.add_argument('--no-near-dup', action='store_true',
+                        help="유사 중복 제거 생략")
+    parser.add_argument('--stream', action='store_true',
+                        help="전체 데이터를 메모리에 올리지 않는 스트리밍 모드")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="샤드별 병렬 클리닝 프로세스 수")
+    parser.add_argument('--index', type=Path, default=None,
+                        help="영구 중복 지문 저장소 (SQLite) 경로. 완전 중복 지문만 저장하며 "
+                             "유사 중복 (MinHash) 시그니처는 실행 간 유지되지 않음")
+    parser.add_argument('--append', action='store_true',
+                        help="증분 모드: 새 배치만 클리닝하여 기존 분할 파일에 추가 (--index 필요, "
+                             "이미 지문이 있는 저장소는 --append 필수)")
+    parser.add_argument('--rules', type=Path, default=DEFAULT_RULES_PATH,
+                        help="품질 필터 / 템플릿 정리 규칙 YAML")
+    parser.add_argument('--group-by', choices=['output', 'topic'], default=None,
+                        help="해시 기반 그룹 분할 키 (스트리밍 모드 기본값: output)")
+    args = parser.parse_args()
+    if args.append and args.index is None:
+        parser.error("--append 는 --index 와 함께 사용해야 합니다")
+    if args.index is not None and args.workers > 1:
+        parser.error("--index 는 --workers 1 에서만 지원합니다")
+    if args.index is not None and not args.append and args.index.exists():
+        # 분할 파일을 새로 쓰면서 기존 지문과 대조하면 이미 본 레코드가 모두 걸러져 데이터가 사라짐
+        with FingerprintStore(args.index) as store:
+            if len(store) > 0:
+                parser.error(f"{args.index} 에 지문 {len(store):,}건이 있습니다. 기존 분할 파일에 추가하려면 "
+                             f"--append 를, 처음부터 다시 만들려면 저장소를 삭제하세요")
+    return args
+
 def main():
     """메인 실행 함수"""
+    args = parse_args()
+
     # 경로 설정
-    input_file = Path("all_data_expanded.jsonl")  # 입력 파일
-    output_dir = Path("cleaned_data")
+    input_file = args.input  # 입력 파일
+    output_dir = args.output_dir
     output_dir.mkdir(exist_ok=True)
+    near_dup_threshold = None if args.no_near_dup else args.near_dup_threshold
+    rules = RuleSet.from_yaml(args.rules)
     
     print("="*70)
     print("HIRA 데이터 클리닝 & 분할")
     print("="*70)
+
+    if args.index is not None:
+        # 증분 모드: 지문 저장소와 대조하며 스트리밍 처리
+        with FingerprintStore(args.index) as store:
+            if args.append and len(store) == 0:
+                split_files = [output_dir / f"{name}.jsonl" for name in ('train', 'val', 'test')]
+                seeded = store.seed_from_files(split_files)
+                print(f"\n🗂️  기존 분할 파일에서 지문 {seeded:,}건 등록")
+            run_stream(input_file, output_dir, near_dup_threshold,
+                       fingerprint_store=store, append=args.append,
+                       group_by=args.group_by or 'output', rules=rules)
+        print("\n" + "="*70)
+        print("✅ 완료!")
+        print("="*70)
+        return
+
+    if args.stream:
+        run_stream(input_file, output_dir, near_dup_threshold, args.workers,
+                   group_by=args.group_by or 'output', rules=rules)
+        print("\n" + "="*70)
+        print("✅ 완료!")
+        print("="*70)
+        return
     
-    # 1. 데이터 로드
-    print(f"\n📂 데이터 로드: {input_file}")
-    data = load_jsonl(input_file)
-    analyze_data(data, "원본 데이터")
-    
-    # 2. 클리닝
-    cleaned_data = clean_data(data)
-    analyze_data(cleaned_data, "정제 데이터")
+    if args.workers > 1:
+        # 1-2. 병렬 로드 + 클리닝
+        print(f"\n📂 병렬 클리닝 ({args.workers} workers): {input_file}")
+        raw_profile = DataProfile()
+        counts = Counter()
+        index = NearDuplicateIndex(threshold=near_dup_threshold) if near_dup_threshold is not None else None
+        cleaned_data = list(clean_parallel(input_file, args.workers, counts, index, raw_profile,
+                                           work_dir=output_dir, rules=rules))
+        raw_profile.report("원본 데이터")
+
+        print("\n" + "="*70)
+        print("데이터 클리닝")
+        print("="*70)
+        print_clean_report(counts, index.stats() if index is not None else None, rules)
+    else:
+        # 1. 데이터 로드
+        print(f"\n📂 데이터 로드: {input_file}")
+        data = load_jsonl(input_file)
+        analyze_data(data, "원본 데이터")
+        
+        # 2. 클리닝
+        cleaned_data = clean_data(data, near_dup_threshold, rules)
+    clean_profile = analyze_data(cleaned_data, "정제 데이터")
+    print(f"  ✅ 프로파일: {clean_profile.save_json(output_dir / 'data_profile.json')}")
     
     # 3. 분할
-    train_data, val_data, test_data = split_data(cleaned_data)
+    train_data, val_data, test_data = split_data(cleaned_data, group_by=args.group_by)
     
     # 4. 저장
     print("\n" + "="*70)
@@ -186,18 +739,11 @@ def main():
     print(f"  ✅ Test:  {test_file}")
     
     # 5. 샘플 출력
-    print("\n" + "="*70)
-    print("샘플 데이터 확인")
-    print("="*70)
-    
-    for i, item in enumerate(train_data[:3], 1):
-        print(f"\n[Train 샘플 {i}]")
-        print(f"Q: {item['instruction']}")
-        print(f"A: {item['output'][:100]}...")
+    print_samples(train_data[:3])
     
     print("\n" + "="*70)
     print("✅ 완료!")
     print("="*70)
 
 if __name__ == "__main__":
-    main()
+    main()
\ No newline at end of file
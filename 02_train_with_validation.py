@@ -5,8 +5,16 @@ SOLAR-10.7B LoRA 학습 - Validation 포함 개선 버전
 - Train/Val 분리
 - Validation loss 기반 Early Stopping
 - 상세 메트릭 로깅
+- 응답 토큰만 loss 계산 (프롬프트 / 패딩 레이블 -100)
+- torchrun 데이터 병렬 (GPU nccl / CPU gloo):
+    torchrun --nproc_per_node=2 02_train_with_validation.py
+- 경로 / 설정 덮어쓰기 (작은 모델로 CPU 검증):
+    python3 02_train_with_validation.py --model-path tiny --data-path data --output-dir out --set num_epochs=1
 """
 
+import argparse
+import itertools
+import math
 import sys
 import os
 
@@ -17,13 +25,39 @@ sys.modules['bitsandbytes'] = None
 import torch
 import json
 from pathlib import Path
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import AutoTokenizer, AutoModelForCausalLM, set_seed
 from peft import LoraConfig, get_peft_model, TaskType
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import DataLoader, Subset
 from tqdm import tqdm
 from datetime import datetime
 import numpy as np
 
+from hira_dataset import (CachedBatches, DynamicPaddingCollator, HIRADataset, LengthBucketSampler, PaddingMeter,
+                          RawTextDataset, StreamingHIRADataset, TokenBudgetSampler, TokenizingCollator,
+                          dataloader_kwargs, format_instruction_prompt, stratified_subsample)
+from train_utils import (AsyncCheckpointer, MetricAccumulator, StepProfiler, accumulation_windows,
+                         all_gather_objects, all_reduce_gradients, apply_config_overrides, barrier,
+                         broadcast_object, broadcast_parameters, build_optimizer, causal_lm_loss,
+                         cleanup_distributed, count_loss_tokens, count_optimizer_steps, find_batch_size,
+                         init_distributed, load_training_state, optimizer_summary, rng_state, set_rng_state,
+                         setup_for_distributed, synchronized_windows, trainable_parameters, window_loss_weights)
+
+parser = argparse.ArgumentParser(description="SOLAR-10.7B LoRA 학습 - Validation 포함")
+parser.add_argument('--resume', nargs='?', const='latest', default=None,
+                    help="학습 재개 체크포인트 (경로 생략 시 OUTPUT_PATH/resume_state)")
+parser.add_argument('--model-path', type=Path, default=None, help="기본 모델 경로 (기본: WORK_DIR 아래 SOLAR)")
+parser.add_argument('--data-path', type=Path, default=None, help="train.jsonl / val.jsonl 디렉토리")
+parser.add_argument('--output-dir', type=Path, default=None, help="체크포인트 / 로그 출력 디렉토리")
+parser.add_argument('--set', dest='overrides', action='append', default=[], metavar='KEY=VALUE',
+                    help="학습 설정 덮어쓰기 (값은 JSON, 예: --set num_epochs=1 --set loss_chunk_size=null)")
+args = parser.parse_args()
+
+# torchrun 실행이면 rank 당 프로세스 하나 (데이터 병렬), 아니면 단일 프로세스
+rank, world_size, device = init_distributed()
+is_main = rank == 0
+distributed = world_size > 1
+setup_for_distributed(is_main)  # 출력은 rank 0 만
+
 print("="*80)
 print("SOLAR-10.7B LoRA 학습 - Validation 개선 버전")
 print("="*80)
@@ -32,15 +66,16 @@ print("="*80)
 # 설정
 # ============================================
 WORK_DIR = Path("/home/work/LLM_Meditron/bigdataAI")
-MODEL_PATH = WORK_DIR / "solar_10.7b_package" / "model"
-DATA_PATH = WORK_DIR / "workspace" / "data" / "hira" / "cleaned_data"
-OUTPUT_PATH = WORK_DIR / "workspace" / "models" / "solar_hira_v3"
+MODEL_PATH = args.model_path or WORK_DIR / "solar_10.7b_package" / "model"
+DATA_PATH = args.data_path or WORK_DIR / "workspace" / "data" / "hira" / "cleaned_data"
+OUTPUT_PATH = args.output_dir or WORK_DIR / "workspace" / "models" / "solar_hira_v3"
 OUTPUT_PATH.mkdir(parents=True, exist_ok=True)
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 print(f"\n📊 환경:")
 print(f"  Device: {device}")
 print(f"  PyTorch: {torch.__version__}")
+if distributed:
+    print(f"  Data parallel: {world_size} ranks ({torch.distributed.get_backend()})")
 if torch.cuda.is_available():
     print(f"  GPU: {torch.cuda.get_device_name(0)}")
     print(f"  VRAM: {torch.cuda.get_device_properties(0).total_memory / 1024**3:.1f} GB")
@@ -51,87 +86,76 @@ if torch.cuda.is_available():
 config = {
     "batch_size": 2,
     "gradient_accumulation_steps": 4,
+    "auto_batch_size": True,         # 시작 전 탐색: batch_size × accumulation (실효 배치 유지) 자동 결정
+    "memory_fraction": 0.9,          # 자동 탐색 메모리 예산 (GPU 메모리 대비)
+    "max_batch_size": None,          # 자동 탐색 상한 (None: 실효 배치 크기까지)
     "learning_rate": 5e-5,
+    "weight_decay": 0.01,            # bias / norm 파라미터는 제외
+    "optimizer_offload": False,      # True: AdamW 상태를 CPU 고정 메모리에 (VRAM 절약, step 느려짐)
     "num_epochs": 15,  # 증가
     "max_length": 512,
     "warmup_steps": 100,
     "logging_steps": 10,
-    "eval_steps": 50,  # Validation 주기
+    "eval_steps": 50,  # Validation 주기 (optimizer step, 부분 표본 / epoch 끝은 항상 전체)
     "patience": 5,     # Early stopping patience 증가
+    "eval_subsample_size": 256,      # step 평가용 길이 층화 고정 표본 크기 (None: 전체 val)
+    "eval_patience": 10,             # step 평가 연속 미개선 횟수 → epoch 중간 early stopping
+    "eval_batch_size": 8,            # no_grad 평가 배치 크기
+    "loss_chunk_size": 1024,         # 응답 위치 N 개씩 LM head + CE (전체 logits 미생성, None: outputs.loss)
+    "token_cache_dir": str(OUTPUT_PATH / "token_cache"),  # 1회 토큰화 캐시
+    "dynamic_padding": True,         # 배치 내 최장 길이로 패딩
+    "packing": False,                # 짧은 샘플을 max_length 행으로 묶기 (block-diagonal attention)
+    "pretokenize": True,             # False: 캐시 없이 collate_fn 에서 배치 토큰화
+    "streaming": False,              # True: 학습 JSONL 을 메모리에 올리지 않고 워커에서 읽으며 토큰화
+    "train_shards": None,            # streaming 학습 샤드 (파일 / 디렉터리 / glob 리스트, None: train.jsonl)
+    "shuffle_buffer_size": 10000,    # streaming 셔플 버퍼 (샘플 수)
+    "num_workers": 2,
+    "prefetch_factor": 4,
+    "length_bucket_multiplier": 50,  # 길이 정렬 구간 = batch_size * 배수
+    "max_tokens_per_batch": None,    # 설정 시 batch_size 대신 (패딩 포함) 토큰 수 상한으로 배치 구성
+    "token_normalized_loss": True,   # accumulation 구간 loss 를 토큰 수 기준으로 정규화
+    "profile_steps": 10,             # step 계측 JSONL 기록 간격 (optimizer step)
+    "save_total_limit": 3,           # val loss 상위 K 개 체크포인트만 보관
+    "resume_save_steps": 200,        # 재개용 상태 저장 간격 (optimizer step, epoch 끝에도 저장)
+    "seed": 42,
 }
+try:
+    apply_config_overrides(config, args.overrides)
+except ValueError as error:
+    parser.error(str(error))
 
 print(f"\n⚙️  학습 설정:")
 for k, v in config.items():
     print(f"  {k}: {v}")
 
-# ============================================
-# Dataset 클래스
-# ============================================
-class HIRADataset(Dataset):
-    def __init__(self, file_path, tokenizer, max_length=512):
-        self.data = []
-        with open(file_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                try:
-                    self.data.append(json.loads(line.strip()))
-                except:
-                    continue
-        
-        self.tokenizer = tokenizer
-        self.max_length = max_length
-        
-        print(f"📂 Loaded {len(self.data)} examples from {file_path.name}")
-    
-    def __len__(self):
-        return len(self.data)
-    
-    def __getitem__(self, idx):
-        item = self.data[idx]
-        instruction = item['instruction'].strip()
-        output = item['output'].strip()
-        
-        prompt = f"### Instruction:\n{instruction}\n\n### Response:\n{output}"
-        
-        encoding = self.tokenizer(
-            prompt,
-            max_length=self.max_length,
-            padding='max_length',
-            truncation=True,
-            return_tensors='pt'
-        )
-        
-        return {
-            'input_ids': encoding['input_ids'].squeeze(),
-            'attention_mask': encoding['attention_mask'].squeeze(),
-            'labels': encoding['input_ids'].squeeze()
-        }
-
 # ============================================
 # Evaluation 함수
 # ============================================
 def evaluate(model, val_loader, device):
-    """Validation 평가"""
+    """Validation 평가 (응답 토큰 가중 평균 loss, 마지막에 한 번만 동기화)"""
     model.eval()
-    total_loss = 0
-    num_batches = 0
+    metrics = MetricAccumulator()
     
     with torch.no_grad():
-        for batch in tqdm(val_loader, desc="Validating", leave=False):
+        for batch in tqdm(val_loader, desc="Validating", leave=False, disable=not is_main):
             input_ids = batch['input_ids'].to(device)
             attention_mask = batch['attention_mask'].to(device)
             labels = batch['labels'].to(device)
             
-            outputs = model(
-                input_ids=input_ids,
+            position_ids = batch['position_ids'].to(device) if 'position_ids' in batch else None
+            
+            lm_loss = causal_lm_loss(
+                model, input_ids, labels,
                 attention_mask=attention_mask,
-                labels=labels
+                position_ids=position_ids,
+                chunk_size=config['loss_chunk_size']
             )
             
-            total_loss += outputs.loss.item()
-            num_batches += 1
+            metrics.add('loss', lm_loss, count_loss_tokens(batch['labels']))
     
     model.train()
-    return total_loss / num_batches
+    # rank 별 val 샤드 합산 → 모든 rank 가 같은 값 (early stopping 판단 일치)
+    return metrics.compute(distributed=True).get('loss', 0.0)
 
 # ============================================
 # 모델 로드
@@ -139,6 +163,9 @@ def evaluate(model, val_loader, device):
 print(f"\n🔄 모델 로딩...")
 print(f"  Path: {MODEL_PATH}")
 
+# LoRA 초기화 / dropout 재현 (재개 시 RNG 는 체크포인트 값으로 덮어씀)
+set_seed(config['seed'])
+
 tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
 if tokenizer.pad_token is None:
     tokenizer.pad_token = tokenizer.eos_token
@@ -146,7 +173,8 @@ if tokenizer.pad_token is None:
 model = AutoModelForCausalLM.from_pretrained(
     MODEL_PATH,
     torch_dtype=torch.bfloat16,
-    device_map="auto",
+    # 데이터 병렬: rank 마다 모델 전체를 자기 device 에 (레이어 분산 없음)
+    device_map={"": device} if distributed else "auto",
     trust_remote_code=True
 )
 
@@ -169,6 +197,9 @@ lora_config = LoraConfig(
 )
 
 model = get_peft_model(model, lora_config)
+if distributed:
+    # LoRA 초기값은 위 seed 로 모든 rank 동일, dropout 은 rank 별로 다르게
+    set_seed(config['seed'] + rank)
 trainable_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
 all_params = sum(p.numel() for p in model.parameters())
 
@@ -183,33 +214,157 @@ print(f"\n📂 데이터 로드...")
 train_file = DATA_PATH / "train.jsonl"
 val_file = DATA_PATH / "val.jsonl"
 
-train_dataset = HIRADataset(train_file, tokenizer, config['max_length'])
-val_dataset = HIRADataset(val_file, tokenizer, config['max_length'])
-
-train_loader = DataLoader(
-    train_dataset,
-    batch_size=config['batch_size'],
-    shuffle=True,
-    num_workers=0
-)
+if config['pretokenize']:
+    dataset_kwargs = dict(
+        prompt_fn=format_instruction_prompt,
+        cache_dir=config['token_cache_dir'],
+        mask_prompt=True,   # 프롬프트 토큰은 loss 제외
+        mask_padding=True,  # 패딩 토큰은 loss 제외
+        padding='longest' if config['dynamic_padding'] else 'max_length',
+    )
+    val_dataset = HIRADataset(val_file, tokenizer, config['max_length'], **dataset_kwargs)
+    collator = DynamicPaddingCollator(tokenizer.pad_token_id, tokenizer.padding_side, mask_dtype=model.dtype)
+else:
+    # 원문 데이터셋 + 마이크로배치 단위 토큰화 (항상 동적 패딩)
+    val_dataset = RawTextDataset(val_file, prompt_fn=format_instruction_prompt)
+    collator = TokenizingCollator(tokenizer, config['max_length'])
+
+if config['streaming']:
+    # 학습 샤드를 워커 / rank 별로 나눠 읽으며 토큰화 (전체 로드 / 캐시 생성 없음)
+    if config['packing'] or config['max_tokens_per_batch']:
+        raise ValueError("streaming 은 packing / max_tokens_per_batch 를 지원하지 않습니다 (샘플 길이를 미리 모름)")
+    train_dataset = StreamingHIRADataset(config['train_shards'] or train_file, tokenizer, config['max_length'],
+                                         prompt_fn=format_instruction_prompt,
+                                         shuffle_buffer_size=config['shuffle_buffer_size'], seed=config['seed'])
+elif config['pretokenize']:
+    train_dataset = HIRADataset(train_file, tokenizer, config['max_length'], packing=config['packing'],
+                                **dataset_kwargs)
+else:
+    train_dataset = RawTextDataset(train_file, prompt_fn=format_instruction_prompt)
+
+# 마이크로배치 크기 자동 탐색 (실제 길이 분포, 실효 배치 = batch_size × accumulation 유지)
+run_config_file = OUTPUT_PATH / "run_config.json"
+if args.resume:
+    # 재개: 샘플러 위치가 맞도록 원래 실행의 배치 설정 그대로 (다시 탐색하면 배치 경계가 달라짐)
+    if not run_config_file.exists():
+        raise FileNotFoundError(f"{run_config_file} 이 없어 원래 실행의 배치 설정을 알 수 없습니다 (재개 불가)")
+    with open(run_config_file, 'r', encoding='utf-8') as f:
+        run_config = json.load(f)
+    for key in ('batch_size', 'gradient_accumulation_steps', 'batch_size_probe'):
+        if key in run_config:
+            config[key] = run_config[key]
+elif config['auto_batch_size'] and not config['max_tokens_per_batch'] and not config['streaming']:
+    def probe_loss(batch):
+        return causal_lm_loss(
+            model,
+            batch['input_ids'].to(device),
+            batch['labels'].to(device),
+            attention_mask=batch['attention_mask'].to(device),
+            position_ids=batch['position_ids'].to(device) if 'position_ids' in batch else None,
+            chunk_size=config['loss_chunk_size']
+        )
 
-val_loader = DataLoader(
-    val_dataset,
-    batch_size=config['batch_size'],
-    shuffle=False,
-    num_workers=0
-)
+    print(f"\n🔎 배치 크기 탐색 (실효 배치 {config['batch_size'] * config['gradient_accumulation_steps']})...")
+    probe = find_batch_size(model, train_dataset, collator,
+                            config['batch_size'] * config['gradient_accumulation_steps'], probe_loss, device,
+                            max_batch_size=config['max_batch_size'], memory_fraction=config['memory_fraction'],
+                            optimizer_offload=config['optimizer_offload'], seed=config['seed'])
+    # 모든 rank 가 같은 배치 설정을 써야 step 수가 맞음 → rank 0 결과 사용
+    probe = broadcast_object(probe)
+    for p in probe['probes']:
+        print(f"  batch_size={p['batch_size']}: {p['status']}, {p.get('tokens_per_sec', '-')} tokens/sec, "
+              f"{p.get('peak_memory_mb', '-')} MB")
+    config['batch_size'] = probe['batch_size']
+    config['gradient_accumulation_steps'] = probe['gradient_accumulation_steps']
+    config['batch_size_probe'] = probe['probes']
+    print(f"  ✅ batch_size={config['batch_size']}, "
+          f"gradient_accumulation_steps={config['gradient_accumulation_steps']}")
+
+# 실행 설정 기록 (탐색 결과 포함, 재개 시 모든 rank 가 읽은 뒤)
+barrier()
+if is_main:
+    with open(run_config_file, 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+
+loader_kwargs = dataloader_kwargs(config['num_workers'], pin_memory=torch.cuda.is_available(),
+                                  prefetch_factor=config['prefetch_factor'], seed=config['seed'])
+
+if config['max_tokens_per_batch'] and not config['pretokenize']:
+    raise ValueError("max_tokens_per_batch 는 토큰 길이가 필요합니다 (pretokenize=True)")
+
+if config['streaming']:
+    # 스트리밍 샘플은 항상 토큰화된 형식 → 동적 패딩, epoch 순서는 데이터셋 셔플 버퍼
+    train_sampler = None
+    train_loader = DataLoader(
+        train_dataset,
+        batch_size=config['batch_size'],
+        collate_fn=DynamicPaddingCollator(tokenizer.pad_token_id, tokenizer.padding_side, mask_dtype=model.dtype),
+        **loader_kwargs
+    )
+    val_collator = collator
+elif config['dynamic_padding'] or config['packing'] or not config['pretokenize']:
+    if config['max_tokens_per_batch']:
+        train_sampler = TokenBudgetSampler(train_dataset.lengths, config['max_tokens_per_batch'], shuffle=True,
+                                           seed=config['seed'], num_replicas=world_size, rank=rank)
+    else:
+        train_sampler = LengthBucketSampler(train_dataset.lengths, config['batch_size'], shuffle=True,
+                                            bucket_multiplier=config['length_bucket_multiplier'],
+                                            seed=config['seed'], num_replicas=world_size, rank=rank)
+    train_loader = DataLoader(train_dataset, batch_sampler=train_sampler, collate_fn=collator, **loader_kwargs)
+    val_collator = collator
+else:
+    # 구간 = 배치 크기 → 길이 정렬 없이 무작위 배치 (epoch 별 seed 고정이라 재개 가능)
+    train_sampler = LengthBucketSampler(train_dataset.lengths, config['batch_size'], shuffle=True,
+                                        bucket_multiplier=1, seed=config['seed'], num_replicas=world_size, rank=rank)
+    train_loader = DataLoader(
+        train_dataset,
+        batch_sampler=train_sampler,
+        **loader_kwargs
+    )
+    val_collator = None
+
+
+def cached_val_batches(indices=None):
+    """평가 배치 1회 생성 후 텐서 캐시 (전체 길이순 정렬, indices: 부분 표본, 데이터 병렬: rank 별 나눠 평가)"""
+    lengths = val_dataset.lengths if indices is None else val_dataset.lengths[indices]
+    sampler = LengthBucketSampler(lengths, config['eval_batch_size'], shuffle=False,
+                                  bucket_multiplier=max(len(lengths), 1), num_replicas=world_size, rank=rank,
+                                  even_shards=False)
+    dataset = val_dataset if indices is None else Subset(val_dataset, indices)
+    return CachedBatches(DataLoader(dataset, batch_sampler=sampler, collate_fn=val_collator,
+                                    **dataloader_kwargs(config['num_workers'],
+                                                        pin_memory=torch.cuda.is_available())))
+
+
+val_loader = cached_val_batches()
+step_val_indices = stratified_subsample(val_dataset.lengths, config['eval_subsample_size'], seed=config['seed'])
+step_val_loader = val_loader if len(step_val_indices) == len(val_dataset) else cached_val_batches(step_val_indices)
+print(f"  Val: {len(val_dataset)} (epoch 끝 전체), step 평가 표본: {len(step_val_indices)} "
+      f"(매 {config['eval_steps']} step)")
 
 # ============================================
 # Optimizer & Scheduler
 # ============================================
-optimizer = torch.optim.AdamW(
-    model.parameters(),
+# 학습 파라미터(LoRA)만 등록 - 동결된 기본 모델 가중치는 optimizer 가 순회하지 않음
+optimizer = build_optimizer(
+    model,
     lr=config['learning_rate'],
-    weight_decay=0.01
+    weight_decay=config['weight_decay'],
+    offload=config['optimizer_offload']
 )
-
-total_steps = len(train_loader) * config['num_epochs'] // config['gradient_accumulation_steps']
+grad_params = trainable_parameters(model)
+print(f"  Optimizer: {optimizer_summary(optimizer)}")
+
+if config['streaming']:
+    # 길이를 미리 모르므로 줄 수로 배치 수 추정
+    num_batches = train_dataset.estimate_batches(config['batch_size'], config['num_workers'])
+    total_steps = config['num_epochs'] * math.ceil(num_batches / config['gradient_accumulation_steps'])
+else:
+    total_steps = count_optimizer_steps(train_loader.batch_sampler, config['num_epochs'],
+                                        config['gradient_accumulation_steps'])
+print(f"  Optimizer steps: {total_steps}")
+if distributed:
+    print(f"  실효 배치: {config['batch_size']} × {config['gradient_accumulation_steps']} × {world_size} ranks")
 scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(
     optimizer,
     T_max=total_steps,
@@ -225,66 +380,218 @@ model.train()
 global_step = 0
 best_val_loss = float('inf')
 patience_counter = 0
+# step 평가 (부분 표본) 기준 - epoch 끝 전체 평가와 따로 비교
+best_step_val_loss = float('inf')
+step_patience_counter = 0
+stop_early = False
 
 history = {
     'train_loss': [],
     'val_loss': [],
+    'step_val_loss': [],  # [global_step, loss]
     'learning_rate': [],
+    'grad_norm': [],
+    'padding_efficiency': [],
     'best_epoch': 0
 }
-
-for epoch in range(config['num_epochs']):
-    epoch_loss = 0
-    progress_bar = tqdm(train_loader, desc=f"Epoch {epoch+1}/{config['num_epochs']}")
+# loss / grad norm 은 device 텐서로 누적하고 로깅 시점에만 동기화
+log_metrics = MetricAccumulator()
+epoch_metrics = MetricAccumulator()
+padding_meter = PaddingMeter()
+# step 단위 시간 분해 / 처리량 (step_metrics.jsonl)
+profiler = StepProfiler(OUTPUT_PATH / "step_metrics.jsonl" if is_main else None, config['profile_steps'], device,
+                        append=bool(args.resume))
+# 학습 파라미터만 CPU 스냅샷 → 백그라운드 safetensors 저장 (best_model 은 최고 체크포인트 링크, rank 0 만)
+checkpointer = AsyncCheckpointer(OUTPUT_PATH, config['save_total_limit'], tokenizer, enabled=is_main,
+                                 resume=bool(args.resume))
+
+# 학습 재개: 가중치 / optimizer / scheduler / 카운터 / 샘플러 위치 / RNG
+RESUME_DIR = "resume_state"
+start_epoch = 0
+start_batch = 0  # 재개 epoch 에서 이미 학습한 마이크로배치 수
+resume_rng = None
+if args.resume:
+    resume_path = OUTPUT_PATH / RESUME_DIR if args.resume == 'latest' else Path(args.resume)
+    state = load_training_state(resume_path, model, optimizer, scheduler)
+    global_step = state['global_step']
+    best_val_loss = state['best_val_loss']
+    patience_counter = state['patience_counter']
+    best_step_val_loss = state['best_step_val_loss']
+    step_patience_counter = state['step_patience_counter']
+    history = state['history']
+    start_epoch = state['epoch']
+    start_batch = state['epoch_batches']
+    # RNG / 로컬 누적 메트릭은 rank 별
+    if len(state['rank_states']) != world_size:
+        raise ValueError(f"재개는 저장 당시와 같은 rank 수로 실행해야 합니다 "
+                         f"(저장: {len(state['rank_states'])}, 현재: {world_size})")
+    if state.get('finished'):
+        # early stopping / 마지막 epoch 까지 끝난 실행 → 이어서 학습하지 않음
+        print(f"✅ 이미 완료된 학습입니다 ({resume_path}, step {global_step}, best val loss {best_val_loss:.4f})")
+        checkpointer.close()
+        profiler.close()
+        cleanup_distributed()
+        sys.exit(0)
+    rank_state = state['rank_states'][rank]
+    log_metrics.load_state_dict(rank_state['log_metrics'], device)
+    epoch_metrics.load_state_dict(rank_state['epoch_metrics'], device)
+    padding_meter.real_tokens, padding_meter.total_tokens = rank_state['padding_tokens']
+    resume_rng = rank_state['rng']
+    print(f"🔁 재개: {resume_path} (epoch {start_epoch + 1}, batch {start_batch}, step {global_step})")
+
+
+def save_resume_state(epoch, epoch_batches, finished=False):
+    """재개용 상태 저장 (백그라운드). epoch_batches: 해당 epoch 에서 학습한 마이크로배치 수
+
+    finished=True: early stopping / 마지막 epoch 완료 → --resume 시 학습 없이 종료
+
+    모든 rank 가 호출한다 (rank 별 RNG / 메트릭 수집, 파일은 rank 0 만 기록).
+    """
+    rank_states = all_gather_objects({
+        'log_metrics': log_metrics.state_dict(),
+        'epoch_metrics': epoch_metrics.state_dict(),
+        'padding_tokens': (padding_meter.real_tokens, padding_meter.total_tokens),
+        'rng': rng_state(),
+    })
+    checkpointer.save_training_state(model, RESUME_DIR, {
+        'optimizer': optimizer.state_dict(),
+        'scheduler': scheduler.state_dict(),
+        'global_step': global_step,
+        'best_val_loss': best_val_loss,
+        'patience_counter': patience_counter,
+        'best_step_val_loss': best_step_val_loss,
+        'step_patience_counter': step_patience_counter,
+        'history': history,
+        'epoch': epoch,
+        'epoch_batches': epoch_batches,
+        'rank_states': rank_states,
+        'finished': finished,
+    })
+
+
+# 모든 rank 가 rank 0 과 같은 학습 파라미터로 시작 (이후 gradient 평균으로 계속 일치)
+broadcast_parameters(grad_params)
+
+if resume_rng is not None:
+    set_rng_state(resume_rng)
+
+avg_train_loss = float('nan')
+
+for epoch in range(start_epoch, config['num_epochs']):
+    # 재개 epoch: 이미 학습한 배치는 건너뛰고 누적 메트릭은 복원값 유지
+    epoch_batches = start_batch if epoch == start_epoch else 0
+    if epoch_batches == 0:
+        epoch_metrics.reset()
+        padding_meter.reset()
+    batches = train_loader
+    if train_sampler is not None:
+        train_sampler.set_epoch(epoch, start_batch=epoch_batches)
+    else:
+        train_dataset.set_epoch(epoch)
+        if epoch_batches:
+            # 스트리밍은 위치로 건너뛸 수 없어 학습한 배치만큼 읽고 버림 (학습 계산 없음)
+            batches = itertools.islice(train_loader, epoch_batches, None)
+    profiler.skip_interval()  # 이전 epoch 평가/저장 시간 제외
+    progress_bar = tqdm(batches, desc=f"Epoch {epoch+1}/{config['num_epochs']}", disable=not is_main)
     
-    for step, batch in enumerate(progress_bar):
-        # Forward
-        input_ids = batch['input_ids'].to(device)
-        attention_mask = batch['attention_mask'].to(device)
-        labels = batch['labels'].to(device)
-        
-        outputs = model(
-            input_ids=input_ids,
-            attention_mask=attention_mask,
-            labels=labels
-        )
-        
-        loss = outputs.loss / config['gradient_accumulation_steps']
-        loss.backward()
+    # Gradient accumulation 구간 단위 (구간 토큰 수로 loss 정규화)
+    windows = accumulation_windows(profiler.timed(progress_bar), config['gradient_accumulation_steps'])
+    if train_sampler is None:
+        # streaming: rank 별 배치 수가 달라 모든 rank 같은 구간 수에서 멈춤
+        windows = synchronized_windows(windows)
+    for window in windows:
+        weights = window_loss_weights(window, config['token_normalized_loss'], distributed=distributed)
+        profiler.start_step()
+
+        for batch, weight in zip(window, weights):
+            padding_meter.update(batch)
+            profiler.count(batch)
+
+            with profiler.phase('h2d'):
+                input_ids = batch['input_ids'].to(device)
+                attention_mask = batch['attention_mask'].to(device)
+                labels = batch['labels'].to(device)
+                # packing 행: 샘플마다 position 0 부터
+                position_ids = batch['position_ids'].to(device) if 'position_ids' in batch else None
+            
+            # Forward
+            with profiler.phase('forward'):
+                lm_loss = causal_lm_loss(
+                    model, input_ids, labels,
+                    attention_mask=attention_mask,
+                    position_ids=position_ids,
+                    chunk_size=config['loss_chunk_size']
+                )
+                loss = lm_loss * weight
+            
+            with profiler.phase('backward'):
+                loss.backward()
+            num_tokens = count_loss_tokens(batch['labels'])
+            log_metrics.add('loss', lm_loss, num_tokens)
+            epoch_metrics.add('loss', lm_loss, num_tokens)
         
-        # Gradient accumulation
-        if (step + 1) % config['gradient_accumulation_steps'] == 0:
-            torch.nn.utils.clip_grad_norm_(model.parameters(), 0.5)
+        with profiler.phase('optimizer'):
+            # 구간 안 backward 는 로컬 누적만, 통신은 여기서 한 번 (LoRA gradient 만)
+            all_reduce_gradients(grad_params)
+            grad_norm = torch.nn.utils.clip_grad_norm_(grad_params, 0.5)
             optimizer.step()
             scheduler.step()
             optimizer.zero_grad()
-            global_step += 1
+        log_metrics.add('grad_norm', grad_norm)
+        global_step += 1
+        epoch_batches += len(window)
+        profiler.end_step(global_step, epoch + 1)
+        
+        # Logging (여기서만 동기화)
+        if global_step % config['logging_steps'] == 0:
+            current_lr = scheduler.get_last_lr()[0]
+            current = log_metrics.compute(distributed=True)
+            log_metrics.reset()
             
-            # Logging
-            if global_step % config['logging_steps'] == 0:
-                current_lr = scheduler.get_last_lr()[0]
-                current_loss = loss.item() * config['gradient_accumulation_steps']
-                
-                history['train_loss'].append(current_loss)
-                history['learning_rate'].append(current_lr)
-                
-                progress_bar.set_postfix({
-                    'loss': f"{current_loss:.4f}",
-                    'lr': f"{current_lr:.2e}"
-                })
+            history['train_loss'].append(current['loss'])
+            history['grad_norm'].append(current['grad_norm'])
+            history['learning_rate'].append(current_lr)
+            
+            progress_bar.set_postfix({
+                'loss': f"{current['loss']:.4f}",
+                'lr': f"{current_lr:.2e}"
+            })
+        
+        # Step 평가 (고정 부분 표본) - 개선이 없으면 epoch 중간에도 중단
+        if config['eval_steps'] and global_step % config['eval_steps'] == 0:
+            step_val_loss = evaluate(model, step_val_loader, device)
+            history['step_val_loss'].append([global_step, step_val_loss])
+            if step_val_loss < best_step_val_loss:
+                best_step_val_loss = step_val_loss
+                step_patience_counter = 0
+            else:
+                step_patience_counter += 1
+            if is_main:
+                progress_bar.write(f"  📊 Step {global_step} Val Loss (표본): {step_val_loss:.4f} "
+                                   f"(patience {step_patience_counter}/{config['eval_patience']})")
+            stop_early = step_patience_counter >= config['eval_patience']
+            profiler.skip_interval()
+        
+        if global_step % config['resume_save_steps'] == 0:
+            save_resume_state(epoch, epoch_batches)
         
-        epoch_loss += loss.item()
+        if stop_early:
+            break
     
     # Epoch 종료 - Training Loss
-    avg_train_loss = epoch_loss / len(train_loader) * config['gradient_accumulation_steps']
+    avg_train_loss = epoch_metrics.compute(distributed=True).get('loss', 0.0)
     
-    # Validation
+    # Validation (전체)
     print(f"\n📊 Epoch {epoch+1} 평가 중...")
     val_loss = evaluate(model, val_loader, device)
     history['val_loss'].append(val_loss)
+    history['padding_efficiency'].append(padding_meter.efficiency)
     
     print(f"  Train Loss: {avg_train_loss:.4f}")
     print(f"  Val Loss:   {val_loss:.4f}")
+    print(f"  Padding Efficiency: {padding_meter.efficiency:.1%}")
+    # rank 별 배치 수가 같으므로 rank 0 처리량 × rank 수
+    print(f"  Throughput: {profiler.summary()['tokens_per_sec'] * world_size:.0f} tokens/sec")
     
     # Best model 저장
     if val_loss < best_val_loss:
@@ -292,28 +599,40 @@ for epoch in range(config['num_epochs']):
         patience_counter = 0
         history['best_epoch'] = epoch + 1
         
-        checkpoint_path = OUTPUT_PATH / "best_model"
-        model.save_pretrained(checkpoint_path)
-        tokenizer.save_pretrained(checkpoint_path)
+        checkpoint_name = f"checkpoint-{global_step}"
+        checkpointer.save(model, checkpoint_name, val_loss, global_step)
         
-        print(f"  ✅ Best model saved (Val Loss: {val_loss:.4f})")
+        print(f"  ✅ Best model saved: {checkpoint_name} (Val Loss: {val_loss:.4f})")
     else:
         patience_counter += 1
         print(f"  ⚠️  No improvement. Patience: {patience_counter}/{config['patience']}")
-        
-        if patience_counter >= config['patience']:
+    
+    # 다음 epoch 처음부터 재개할 수 있도록 저장 (학습을 끝내는 경우 완료 표시)
+    finished = stop_early or patience_counter >= config['patience'] or epoch + 1 == config['num_epochs']
+    save_resume_state(epoch + 1, 0, finished)
+    
+    if stop_early or patience_counter >= config['patience']:
+        if stop_early:
+            print(f"\n🛑 Early stopping triggered at step {global_step} (epoch {epoch+1}, 표본 val loss "
+                  f"{config['eval_patience']}회 연속 미개선)")
+        else:
             print(f"\n🛑 Early stopping triggered at epoch {epoch+1}")
-            print(f"   Best Val Loss: {best_val_loss:.4f} at epoch {history['best_epoch']}")
-            break
+        print(f"   Best Val Loss: {best_val_loss:.4f} at epoch {history['best_epoch']}")
+        break
     
     print()
 
+profiler.close()
+
 # ============================================
 # 최종 저장
 # ============================================
 final_path = OUTPUT_PATH / "final_model"
-model.save_pretrained(final_path)
-tokenizer.save_pretrained(final_path)
+checkpointer.save(model, "final_model")
+checkpointer.close()
+cleanup_distributed()
+if not is_main:
+    sys.exit(0)
 
 # 히스토리 저장
 history_file = OUTPUT_PATH / "training_history.json"
@@ -329,6 +648,9 @@ with open(log_file, 'w') as f:
     f.write(f"Best Epoch: {history['best_epoch']}\n")
     f.write(f"Best Val Loss: {best_val_loss:.4f}\n")
     f.write(f"Final Train Loss: {avg_train_loss:.4f}\n")
+    f.write(f"\nThroughput:\n")
+    for line in profiler.summary_lines():
+        f.write(f"  {line}\n")
     f.write(f"\nConfig:\n")
     for k, v in config.items():
         f.write(f"  {k}: {v}\n")
@@ -340,4 +662,5 @@ print(f"  Best Epoch: {history['best_epoch']}")
 print(f"  Model: {final_path}")
 print(f"  History: {history_file}")
 print(f"  Log: {log_file}")
+print(f"  Step Metrics: {OUTPUT_PATH / 'step_metrics.jsonl'}")
 print("="*80)
@@ -18,10 +18,15 @@ import json
 from pathlib import Path
 from transformers import AutoTokenizer, AutoModelForCausalLM
 from peft import PeftModel
+from torch.utils.data import DataLoader
 from tqdm import tqdm
 import numpy as np
 from collections import defaultdict
 
+from hira_dataset import LengthBucketSampler, RawTextDataset, TokenizingCollator, format_instruction_prompt
+from jsonl_io import load_jsonl
+from train_utils import MetricAccumulator, causal_lm_loss, count_loss_tokens
+
 # ============================================
 # 설정
 # ============================================
@@ -31,6 +36,8 @@ LORA_MODEL_PATH = WORK_DIR / "workspace" / "models" / "solar_hira_v3" / "best_mo
 TEST_FILE = WORK_DIR / "workspace" / "data" / "hira" / "cleaned_data" / "test.jsonl"
 OUTPUT_DIR = WORK_DIR / "workspace" / "evaluation"
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+PPL_BATCH_SIZE = 8
+LOSS_CHUNK_SIZE = 1024  # 응답 위치 N 개씩 LM head + CE (전체 vocab logits 미생성)
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -62,13 +69,7 @@ print("✅ 모델 로드 완료")
 # 테스트 데이터 로드
 # ============================================
 print(f"\n테스트 데이터 로드: {TEST_FILE}")
-test_data = []
-with open(TEST_FILE, 'r', encoding='utf-8') as f:
-    for line in f:
-        try:
-            test_data.append(json.loads(line.strip()))
-        except:
-            continue
+test_data = load_jsonl(TEST_FILE)
 print(f"✅ {len(test_data)}개 샘플 로드")
 
 # ============================================
@@ -191,6 +192,27 @@ def check_hallucination(question, reference, hypothesis):
     
     return 0
 
+def calculate_perplexity(file_path, batch_size=PPL_BATCH_SIZE):
+    """응답 토큰 perplexity (프롬프트 제외, 학습과 같은 프롬프트 형식)"""
+    dataset = RawTextDataset(file_path, prompt_fn=format_instruction_prompt)
+    # 빈 테스트 파일이면 구간 크기 0 → range step 0 오류 방지
+    sampler = LengthBucketSampler(dataset.lengths, batch_size, shuffle=False, bucket_multiplier=max(len(dataset), 1))
+    loader = DataLoader(dataset, batch_sampler=sampler, collate_fn=TokenizingCollator(tokenizer, 512))
+    metrics = MetricAccumulator()
+    
+    with torch.no_grad():
+        for batch in tqdm(loader, desc="Perplexity"):
+            lm_loss = causal_lm_loss(
+                model,
+                batch['input_ids'].to(device),
+                batch['labels'].to(device),
+                attention_mask=batch['attention_mask'].to(device),
+                chunk_size=LOSS_CHUNK_SIZE
+            )
+            metrics.add('nll', lm_loss, count_loss_tokens(batch['labels']))
+    
+    return float(np.exp(metrics.compute().get('nll', 0.0)))
+
 # ============================================
 # 평가 실행
 # ============================================
@@ -243,6 +265,8 @@ print("\n" + "="*80)
 print("평가 결과")
 print("="*80)
 
+perplexity = calculate_perplexity(TEST_FILE)
+
 avg_bleu = np.mean(results['bleu'])
 avg_rouge = np.mean(results['rouge_l'])
 avg_em = np.mean(results['exact_match'])
@@ -253,6 +277,7 @@ print(f"  BLEU:              {avg_bleu:.4f}")
 print(f"  ROUGE-L:           {avg_rouge:.4f}")
 print(f"  Exact Match:       {avg_em:.4f} ({avg_em*100:.1f}%)")
 print(f"  Hallucination:     {hallucination_rate:.4f} ({hallucination_rate*100:.1f}%)")
+print(f"  Perplexity:        {perplexity:.4f}")
 
 # ============================================
 # 결과 저장
@@ -264,7 +289,8 @@ summary = {
         'bleu': round(avg_bleu, 4),
         'rouge_l': round(avg_rouge, 4),
         'exact_match': round(avg_em, 4),
-        'hallucination_rate': round(hallucination_rate, 4)
+        'hallucination_rate': round(hallucination_rate, 4),
+        'perplexity': round(perplexity, 4)
     },
     'num_samples': len(test_data),
     'samples': results['samples']
@@ -289,7 +315,8 @@ with open(report_file, 'w', encoding='utf-8') as f:
     f.write(f"  BLEU:              {avg_bleu:.4f}\n")
     f.write(f"  ROUGE-L:           {avg_rouge:.4f}\n")
     f.write(f"  Exact Match:       {avg_em:.4f} ({avg_em*100:.1f}%)\n")
-    f.write(f"  Hallucination:     {hallucination_rate:.4f} ({hallucination_rate*100:.1f}%)\n\n")
+    f.write(f"  Hallucination:     {hallucination_rate:.4f} ({hallucination_rate*100:.1f}%)\n")
+    f.write(f"  Perplexity:        {perplexity:.4f}\n\n")
     
     f.write("="*80 + "\n")
     f.write("샘플 결과 (처음 10개)\n")
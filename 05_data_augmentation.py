@@ -7,33 +7,17 @@
 - 질문 변형
 """
 
-import json
 import time
 from pathlib import Path
 from tqdm import tqdm
 import random
 
+from jsonl_io import load_jsonl, save_jsonl
+
 # OpenAI API 설정 (사용 시 API 키 필요)
 # from openai import OpenAI
 # client = OpenAI(api_key="YOUR_API_KEY")
 
-def load_jsonl(file_path):
-    """JSONL 파일 로드"""
-    data = []
-    with open(file_path, 'r', encoding='utf-8') as f:
-        for line in f:
-            try:
-                data.append(json.loads(line.strip()))
-            except:
-                continue
-    return data
-
-def save_jsonl(data, file_path):
-    """JSONL 파일 저장"""
-    with open(file_path, 'w', encoding='utf-8') as f:
-        for item in data:
-            f.write(json.dumps(item, ensure_ascii=False) + '\n')
-
 # ============================================
 # 방법 1: 규칙 기반 변형 (무료)
 # ============================================
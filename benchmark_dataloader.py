@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+DataLoader 처리량 벤치마크 (batches/sec)
+- per-item: __getitem__ 에서 샘플마다 토크나이저 호출 (기존 방식)
+- cache: 1회 토큰화 memmap 캐시 + 동적 패딩
+- collate: 원문 데이터셋 + collate_fn 에서 마이크로배치 단위 토큰화
+
+사용 예:
+    python3 benchmark_dataloader.py --model ./solar_10.7b_package/model \\
+        --data cleaned_data/train.jsonl --workers 0 2 4
+"""
+
+import argparse
+import os
+import time
+
+from torch.utils.data import DataLoader, Dataset
+from transformers import AutoTokenizer
+
+from hira_dataset import (DynamicPaddingCollator, HIRADataset, RawTextDataset, TokenizingCollator,
+                          dataloader_kwargs, format_instruction_prompt)
+
+
+class PerItemDataset(Dataset):
+    """기존 방식: 샘플마다 토크나이저를 호출하고 max_length 로 패딩"""
+
+    def __init__(self, file_path, tokenizer, max_length):
+        self.samples = RawTextDataset(file_path).samples
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, idx):
+        prompt, response = self.samples[idx]
+        encoded = self.tokenizer(prompt + response, truncation=True, max_length=self.max_length,
+                                 padding='max_length', return_tensors='pt')
+        input_ids = encoded['input_ids'].squeeze()
+        return {
+            'input_ids': input_ids,
+            'attention_mask': encoded['attention_mask'].squeeze(),
+            'labels': input_ids.clone()
+        }
+
+
+def measure(loader, num_batches, warmup=2):
+    """num_batches 개 배치를 읽는 처리량 (필요하면 epoch 반복)"""
+    def batches():
+        while True:
+            yield from loader
+
+    it = batches()
+    for _ in range(warmup):
+        next(it)
+
+    start = time.perf_counter()
+    for _ in range(num_batches):
+        next(it)
+    elapsed = time.perf_counter() - start
+    return num_batches / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DataLoader 처리량 벤치마크")
+    parser.add_argument('--model', required=True, help="토크나이저 경로")
+    parser.add_argument('--data', required=True, help="학습 JSONL 경로")
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--max-length', type=int, default=512)
+    parser.add_argument('--batches', type=int, default=200, help="측정 배치 수")
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2])
+    parser.add_argument('--prefetch-factor', type=int, default=4)
+    parser.add_argument('--cache-dir', default=None, help="토큰 캐시 루트")
+    args = parser.parse_args()
+
+    # 부모 프로세스에서 토크나이저를 쓴 뒤 fork 하므로 Rust 스레드 풀 경고 방지
+    os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model, trust_remote_code=True)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    print("="*80)
+    print("DataLoader 처리량 벤치마크")
+    print("="*80)
+    print(f"  batch_size: {args.batch_size}, max_length: {args.max_length}, batches: {args.batches}")
+
+    per_item = PerItemDataset(args.data, tokenizer, args.max_length)
+    cached = HIRADataset(args.data, tokenizer, args.max_length, prompt_fn=format_instruction_prompt,
+                         cache_dir=args.cache_dir, padding='longest')
+    raw = RawTextDataset(args.data, prompt_fn=format_instruction_prompt)
+
+    paths = {
+        'per-item': (per_item, None),
+        'cache': (cached, DynamicPaddingCollator(tokenizer.pad_token_id, tokenizer.padding_side)),
+        'collate': (raw, TokenizingCollator(tokenizer, args.max_length)),
+    }
+
+    results = {}
+    for num_workers in args.workers:
+        for name, (dataset, collate_fn) in paths.items():
+            loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, collate_fn=collate_fn,
+                                **dataloader_kwargs(num_workers, prefetch_factor=args.prefetch_factor))
+            results[(name, num_workers)] = measure(loader, args.batches)
+            del loader
+
+    print(f"\n📊 batches/sec:")
+    print(f"  {'workers':>8s}" + ''.join(f"{name:>12s}" for name in paths))
+    for num_workers in args.workers:
+        row = ''.join(f"{results[(name, num_workers)]:12.1f}" for name in paths)
+        print(f"  {num_workers:>8d}{row}")
+
+    baseline = results[('per-item', args.workers[0])]
+    print(f"\n  (per-item, workers={args.workers[0]} 대비)")
+    for (name, num_workers), rate in results.items():
+        print(f"    {name:10s} workers={num_workers}: {rate / baseline:5.2f}x")
+    print("="*80)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,8 @@ from typing import List, Dict
 from itertools import product
 import re
 
+from jsonl_io import save_jsonl
+
 class BigDataPortalDataGenerator:
     def __init__(self, config_dir: str):
         """
@@ -431,15 +433,13 @@ class BigDataPortalDataGenerator:
         output_path = Path(output_path)
         output_path.parent.mkdir(parents=True, exist_ok=True)
 
-        with open(output_path, 'w', encoding='utf-8') as f:
-            for item in self.generated_data:
-                # metadata 포함 여부 선택
-                if not include_metadata and 'metadata' in item:
-                    output_item = {k: v for k, v in item.items() if k != 'metadata'}
-                else:
-                    output_item = item
-
-                f.write(json.dumps(output_item, ensure_ascii=False) + '\n')
+        # metadata 포함 여부 선택
+        save_jsonl(
+            (item if include_metadata or 'metadata' not in item
+             else {k: v for k, v in item.items() if k != 'metadata'}
+             for item in self.generated_data),
+            output_path
+        )
 
         print(f"\n✅ 저장 완료: {output_path}")
         print(f"   총 {len(self.generated_data):,}건")
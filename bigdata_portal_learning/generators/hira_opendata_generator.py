@@ -13,6 +13,8 @@ from pathlib import Path
 from typing import List, Dict
 from collections import Counter
 
+from jsonl_io import save_jsonl
+
 class HIRAOpenDataGenerator:
     def __init__(self, structure_path: str):
         """초기화"""
@@ -452,18 +454,15 @@ class HIRAOpenDataGenerator:
         output_path = Path(output_path)
         output_path.parent.mkdir(parents=True, exist_ok=True)
 
-        with open(output_path, 'w', encoding='utf-8') as f:
-            for item in self.training_data:
-                if include_metadata:
-                    f.write(json.dumps(item, ensure_ascii=False) + '\n')
-                else:
-                    # 메타데이터 제외
-                    simple_item = {
-                        "instruction": item['instruction'],
-                        "input": item['input'],
-                        "output": item['output']
-                    }
-                    f.write(json.dumps(simple_item, ensure_ascii=False) + '\n')
+        if include_metadata:
+            save_jsonl(self.training_data, output_path)
+        else:
+            # 메타데이터 제외
+            save_jsonl(
+                ({"instruction": item['instruction'], "input": item['input'], "output": item['output']}
+                 for item in self.training_data),
+                output_path
+            )
 
         print(f"✅ JSONL 저장 완료: {output_path}")
         print(f"   총 {len(self.training_data):,}건\n")
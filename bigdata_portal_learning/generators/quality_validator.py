@@ -5,11 +5,20 @@
 중복 제거, 유효성 체크, 통계 분석
 """
 
-import json
 from pathlib import Path
 from collections import Counter
 from typing import List, Dict, Tuple
 
+from data_profile import LengthProfile
+from jsonl_io import load_jsonl, save_jsonl
+from text_normalize import canonical_key
+
+# 길이 임계값: (최소, 최대)
+LENGTH_THRESHOLDS = {
+    'instruction': (5, 100),
+    'output': (30, 500),
+}
+
 class DataQualityValidator:
     def __init__(self, data_path: str):
         """
@@ -20,30 +29,38 @@ class DataQualityValidator:
         """
         self.data_path = Path(data_path)
         self.data = []
+        self._profile = None
         self.load_data()
 
     def load_data(self):
         """데이터 로드"""
         print(f"데이터 로드 중: {self.data_path}")
 
-        with open(self.data_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                try:
-                    item = json.loads(line.strip())
-                    self.data.append(item)
-                except:
-                    continue
+        self.data = load_jsonl(self.data_path)
 
         print(f"✅ 로드 완료: {len(self.data):,}건\n")
 
+    @property
+    def profile(self) -> LengthProfile:
+        """필드 길이 프로파일 (최초 조회 시 한 번만 계산)"""
+        if self._profile is None:
+            self._profile = LengthProfile.from_records(self.data)
+        return self._profile
+
+    def export_profile(self, output_path: str):
+        """길이 프로파일 JSON 저장 (백분위수, 히스토그램, 임계값 위반 인덱스)"""
+        path = self.profile.save_json(output_path, thresholds=LENGTH_THRESHOLDS)
+        print(f"  ✅ 프로파일 저장: {path}")
+        return path
+
     def check_duplicates(self) -> Tuple[int, List[str]]:
         """중복 체크"""
         print("="*80)
         print("1️⃣  중복 체크")
         print("="*80)
 
-        questions = [item['instruction'] for item in self.data]
-        question_counts = Counter(questions)
+        # 표기만 다른 질문(NFC/NFD, 공백, 끝의 '?', 인사말)은 같은 질문으로 집계
+        question_counts = Counter(canonical_key(item['instruction']) for item in self.data)
 
         duplicates = {q: count for q, count in question_counts.items() if count > 1}
 
@@ -63,47 +80,47 @@ class DataQualityValidator:
         print("2️⃣  길이 체크")
         print("="*80)
 
-        q_lengths = [len(item['instruction']) for item in self.data]
-        a_lengths = [len(item['output']) for item in self.data]
+        q_min, q_max = LENGTH_THRESHOLDS['instruction']
+        a_min, a_max = LENGTH_THRESHOLDS['output']
+        q_stats = self.profile.summary('instruction')
+        a_stats = self.profile.summary('output')
 
         print(f"\n[질문 길이]")
-        print(f"  평균: {sum(q_lengths) / len(q_lengths):.1f}자")
-        print(f"  최소: {min(q_lengths)}자")
-        print(f"  최대: {max(q_lengths)}자")
-        print(f"  중앙값: {sorted(q_lengths)[len(q_lengths)//2]}자")
+        print(f"  평균: {q_stats['mean']:.1f}자")
+        print(f"  최소: {q_stats['min']}자")
+        print(f"  최대: {q_stats['max']}자")
+        print(f"  중앙값: {q_stats['percentiles']['p50']:.0f}자")
 
         # 너무 짧거나 긴 질문
-        too_short = [item for item in self.data if len(item['instruction']) < 5]
-        too_long = [item for item in self.data if len(item['instruction']) > 100]
+        too_short, too_long = self.profile.violations('instruction', q_min, q_max)
 
-        if too_short:
-            print(f"\n  ⚠️  너무 짧은 질문 ({len(too_short)}건): 5자 미만")
-            for item in too_short[:3]:
-                print(f"     - {item['instruction']}")
+        if too_short.size:
+            print(f"\n  ⚠️  너무 짧은 질문 ({too_short.size}건): {q_min}자 미만")
+            for idx in too_short[:3]:
+                print(f"     - {self.data[idx]['instruction']}")
 
-        if too_long:
-            print(f"\n  ⚠️  너무 긴 질문 ({len(too_long)}건): 100자 초과")
-            for item in too_long[:3]:
-                print(f"     - {item['instruction'][:80]}...")
+        if too_long.size:
+            print(f"\n  ⚠️  너무 긴 질문 ({too_long.size}건): {q_max}자 초과")
+            for idx in too_long[:3]:
+                print(f"     - {self.data[idx]['instruction'][:80]}...")
 
         print(f"\n[답변 길이]")
-        print(f"  평균: {sum(a_lengths) / len(a_lengths):.1f}자")
-        print(f"  최소: {min(a_lengths)}자")
-        print(f"  최대: {max(a_lengths)}자")
-        print(f"  중앙값: {sorted(a_lengths)[len(a_lengths)//2]}자")
+        print(f"  평균: {a_stats['mean']:.1f}자")
+        print(f"  최소: {a_stats['min']}자")
+        print(f"  최대: {a_stats['max']}자")
+        print(f"  중앙값: {a_stats['percentiles']['p50']:.0f}자")
 
         # 너무 짧거나 긴 답변
-        too_short_a = [item for item in self.data if len(item['output']) < 30]
-        too_long_a = [item for item in self.data if len(item['output']) > 500]
+        too_short_a, too_long_a = self.profile.violations('output', a_min, a_max)
 
-        if too_short_a:
-            print(f"\n  ⚠️  너무 짧은 답변 ({len(too_short_a)}건): 30자 미만")
-            for item in too_short_a[:3]:
-                print(f"     Q: {item['instruction']}")
-                print(f"     A: {item['output']}\n")
+        if too_short_a.size:
+            print(f"\n  ⚠️  너무 짧은 답변 ({too_short_a.size}건): {a_min}자 미만")
+            for idx in too_short_a[:3]:
+                print(f"     Q: {self.data[idx]['instruction']}")
+                print(f"     A: {self.data[idx]['output']}\n")
 
-        if too_long_a:
-            print(f"\n  ⚠️  너무 긴 답변 ({len(too_long_a)}건): 500자 초과")
+        if too_long_a.size:
+            print(f"\n  ⚠️  너무 긴 답변 ({too_long_a.size}건): {a_max}자 초과")
 
     def check_quality(self):
         """품질 체크"""
@@ -211,7 +228,7 @@ class DataQualityValidator:
         unique_data = []
 
         for item in self.data:
-            q = item['instruction']
+            q = canonical_key(item['instruction'])
             if q not in seen_questions:
                 seen_questions.add(q)
                 unique_data.append(item)
@@ -227,9 +244,7 @@ class DataQualityValidator:
             output_path = Path(output_path)
             output_path.parent.mkdir(parents=True, exist_ok=True)
 
-            with open(output_path, 'w', encoding='utf-8') as f:
-                for item in unique_data:
-                    f.write(json.dumps(item, ensure_ascii=False) + '\n')
+            save_jsonl(unique_data, output_path)
 
             print(f"\n  ✅ 저장 완료: {output_path}")
         else:
@@ -294,12 +309,14 @@ def main():
     # 경로 설정
     input_file = Path(__file__).parent.parent / 'output' / 'bigdata_portal_train.jsonl'
     output_file = Path(__file__).parent.parent / 'output' / 'bigdata_portal_train_clean.jsonl'
+    profile_file = Path(__file__).parent.parent / 'output' / 'bigdata_portal_train_profile.json'
 
     # 검증기 실행
     validator = DataQualityValidator(input_file)
 
     # 전체 리포트 생성
     validator.generate_report()
+    validator.export_profile(profile_file)
 
     # 중복 제거 후 저장
     final_count = validator.remove_duplicates(output_file)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+선언형 클리닝 규칙 엔진
+- YAML 로 품질 필터 / 템플릿 정리 규칙 정의
+- 필드별 부분 문자열 규칙을 하나의 정규식으로 합쳐 레코드당 한 번만 스캔
+- 규칙별 적중 수와 누적 시간 집계
+"""
+
+import re
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import yaml
+
+DEFAULT_RULES_PATH = Path(__file__).parent / "config" / "cleaning_rules.yaml"
+
+FILTER_TYPES = ('min_length', 'max_length', 'max_count', 'contains')
+
+
+class Rule:
+    """규칙 하나 (필터 또는 치환)"""
+
+    def __init__(self, spec, kind):
+        self.kind = kind
+        self.name = spec['name']
+        self.type = spec.get('type', 'replace')
+        self.field = spec.get('field', 'output')
+        self.value = spec.get('value', 0)
+        self.patterns = spec.get('patterns') or ([spec['pattern']] if 'pattern' in spec else [])
+
+        # 치환 규칙
+        self.replacement = spec.get('replacement', '')
+        self.strip = spec.get('strip', False)
+        when = spec.get('when') or {}
+        self.when_patterns = when.get('patterns') or ([when['pattern']] if 'pattern' in when else [])
+        self.when_count = when.get('count')
+
+        self.hits = 0
+        self.seconds = 0.0
+
+        if kind == 'filter' and self.type not in FILTER_TYPES:
+            raise ValueError(f"알 수 없는 필터 규칙 타입: {self.type} ({self.name})")
+        if kind == 'filter' and self.type in ('max_count', 'contains') and not self.patterns:
+            raise ValueError(f"pattern(s) 가 필요한 규칙입니다: {self.name}")
+        if kind == 'rewrite' and not self.patterns:
+            raise ValueError(f"치환 규칙에 pattern 이 없습니다: {self.name}")
+
+    def scan_patterns(self):
+        """필드 스캔 정규식에 포함할 부분 문자열"""
+        return self.patterns + self.when_patterns
+
+    def rejects(self, value, counts):
+        """필터 규칙: 레코드를 제거해야 하면 True"""
+        if self.type == 'min_length':
+            return len(value.strip()) < self.value
+        if self.type == 'max_length':
+            return len(value.strip()) > self.value
+        total = sum(counts.get(p, 0) for p in self.patterns)
+        if self.type == 'max_count':
+            return total > self.value
+        return total > 0  # contains
+
+    def applies(self, counts):
+        """치환 규칙: 적용 조건 충족 여부"""
+        if self.when_count is not None:
+            return sum(counts.get(p, 0) for p in self.when_patterns) == self.when_count
+        return any(counts.get(p, 0) for p in self.patterns)
+
+    def rewrite(self, value):
+        for pattern in self.patterns:
+            value = value.replace(pattern, self.replacement)
+        return value.strip() if self.strip else value
+
+
+class FieldScanner:
+    """한 필드의 모든 부분 문자열 규칙을 하나의 정규식으로 스캔
+
+    긴 패턴을 먼저 두는 lookahead alternation 이라 위치마다 가장 긴 패턴이
+    잡히고, 그 패턴의 접두사인 짧은 패턴도 같은 위치에서 함께 집계된다.
+    결과는 패턴별 str.count 와 같다 (자기 자신과 겹치는 패턴 제외).
+    """
+
+    def __init__(self, field, patterns):
+        self.field = field
+        self.patterns = sorted(set(patterns), key=len, reverse=True)
+        self.regex = re.compile('(?=(' + '|'.join(re.escape(p) for p in self.patterns) + '))')
+        # 긴 패턴이 잡혔을 때 같은 위치에서 함께 일치하는 (접두사) 패턴들
+        self.prefixes = {p: [q for q in self.patterns if p.startswith(q)] for p in self.patterns}
+        self.seconds = 0.0
+
+    def scan(self, value):
+        start = time.perf_counter()
+        counts = defaultdict(int)
+        # 같은 패턴끼리 겹치는 일치는 str.count 처럼 제외
+        next_free = {}
+        for match in self.regex.finditer(value):
+            pos = match.start()
+            for pattern in self.prefixes[match.group(1)]:
+                if pos >= next_free.get(pattern, 0):
+                    counts[pattern] += 1
+                    next_free[pattern] = pos + len(pattern)
+        self.seconds += time.perf_counter() - start
+        return counts
+
+
+class RuleSet:
+    """필터 → 치환 규칙을 레코드당 한 번의 스캔으로 적용"""
+
+    def __init__(self, filters=(), rewrites=()):
+        self.filters = [Rule(spec, 'filter') for spec in filters]
+        self.rewrites = [Rule(spec, 'rewrite') for spec in rewrites]
+
+        patterns = defaultdict(list)
+        for rule in self.filters + self.rewrites:
+            patterns[rule.field].extend(rule.scan_patterns())
+        self.scanners = {field: FieldScanner(field, pats) for field, pats in patterns.items() if pats}
+
+    @classmethod
+    def from_yaml(cls, path=DEFAULT_RULES_PATH):
+        with open(path, 'r', encoding='utf-8') as f:
+            spec = yaml.safe_load(f) or {}
+        return cls(spec.get('filters', []), spec.get('rewrites', []))
+
+    @property
+    def rules(self):
+        return self.filters + self.rewrites
+
+    def process(self, item):
+        """레코드 하나 처리
+
+        Returns:
+            (item, None): 통과 (치환 규칙 적용됨, item 은 제자리 수정)
+            (None, rule_name): 필터에 걸린 경우
+        """
+        counts = {field: scanner.scan(item.get(field, '')) for field, scanner in self.scanners.items()}
+
+        for rule in self.filters:
+            start = time.perf_counter()
+            rejected = rule.rejects(item.get(rule.field, ''), counts.get(rule.field, {}))
+            rule.seconds += time.perf_counter() - start
+            if rejected:
+                rule.hits += 1
+                return None, rule.name
+
+        for rule in self.rewrites:
+            start = time.perf_counter()
+            if rule.applies(counts.get(rule.field, {})):
+                item[rule.field] = rule.rewrite(item[rule.field])
+                rule.hits += 1
+            rule.seconds += time.perf_counter() - start
+
+        return item, None
+
+    def stats(self):
+        """규칙별 적중 수 / 누적 시간 (병렬 워커 결과 병합용)"""
+        stats = {f"scan:{field}": (0, scanner.seconds) for field, scanner in self.scanners.items()}
+        for rule in self.rules:
+            stats[rule.name] = (rule.hits, rule.seconds)
+        return stats
+
+    def merge_stats(self, stats):
+        for field, scanner in self.scanners.items():
+            scanner.seconds += stats.get(f"scan:{field}", (0, 0.0))[1]
+        for rule in self.rules:
+            hits, seconds = stats.get(rule.name, (0, 0.0))
+            rule.hits += hits
+            rule.seconds += seconds
+
+    def report(self):
+        """규칙별 적중 수 / 누적 시간 출력"""
+        print(f"\n  규칙별 통계:")
+        for field, scanner in self.scanners.items():
+            print(f"    {'[scan] ' + field:32s} {'':>8s}  {scanner.seconds * 1000:8.1f}ms  "
+                  f"(패턴 {len(scanner.patterns)}개)")
+        for rule in self.rules:
+            print(f"    {'[' + rule.kind + '] ' + rule.name:32s} {rule.hits:>7,}건  {rule.seconds * 1000:8.1f}ms")
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+데이터셋 길이 프로파일링
+- 필드별 길이(문자 / 바이트 / 선택적으로 토큰)를 한 번만 계산해 NumPy 배열로 보관
+- 백분위수, 히스토그램, 임계값 위반 인덱스를 벡터 연산으로 계산
+- JSON 내보내기
+"""
+
+import json
+from array import array
+from pathlib import Path
+
+import numpy as np
+
+DEFAULT_PERCENTILES = (5, 25, 50, 75, 95, 99)
+DEFAULT_BINS = 20
+
+
+class LengthProfile:
+    """레코드 필드 길이 프로파일
+
+    update() 로 스트리밍 누적하거나 from_records() 로 한 번에 생성한다.
+    길이는 compact array 로 모아 두었다가 조회 시 NumPy 배열로 변환한다.
+    """
+
+    def __init__(self, fields=('instruction', 'output'), count_tokens=None):
+        """
+        Args:
+            fields: 프로파일링할 필드
+            count_tokens: 텍스트 → 토큰 수 함수 (선택, 예: 토크나이저 래퍼)
+        """
+        self.fields = tuple(fields)
+        self.count_tokens = count_tokens
+        self.metrics = ('chars', 'bytes') + (('tokens',) if count_tokens else ())
+        self._lengths = {(f, m): array('I') for f in self.fields for m in self.metrics}
+        self._cache = {}
+
+    @classmethod
+    def from_records(cls, records, fields=('instruction', 'output'), count_tokens=None):
+        profile = cls(fields, count_tokens)
+        for item in records:
+            profile.update(item)
+        return profile
+
+    def __len__(self):
+        return len(self._lengths[(self.fields[0], 'chars')])
+
+    def update(self, item):
+        for field in self.fields:
+            text = item.get(field, '')
+            self._lengths[(field, 'chars')].append(len(text))
+            self._lengths[(field, 'bytes')].append(len(text.encode('utf-8')))
+            if self.count_tokens:
+                self._lengths[(field, 'tokens')].append(self.count_tokens(text))
+        self._cache.clear()
+
+    def lengths(self, field, metric='chars'):
+        """필드 길이 배열 (np.ndarray, 조회 결과 캐시)"""
+        key = (field, metric)
+        if key not in self._cache:
+            self._cache[key] = np.frombuffer(self._lengths[key], dtype=np.uint32).astype(np.int64)
+        return self._cache[key]
+
+    def summary(self, field, metric='chars', percentiles=DEFAULT_PERCENTILES, bins=DEFAULT_BINS):
+        """평균 / 최소 / 최대 / 백분위수 / 히스토그램"""
+        values = self.lengths(field, metric)
+        if values.size == 0:
+            return {'count': 0}
+
+        pct = np.percentile(values, percentiles)
+        counts, edges = np.histogram(values, bins=bins)
+        return {
+            'count': int(values.size),
+            'mean': float(values.mean()),
+            'min': int(values.min()),
+            'max': int(values.max()),
+            'std': float(values.std()),
+            'percentiles': {f"p{p}": float(v) for p, v in zip(percentiles, pct)},
+            'histogram': {'counts': counts.tolist(), 'edges': edges.tolist()},
+        }
+
+    def violations(self, field, min_len=None, max_len=None, metric='chars'):
+        """임계값 위반 인덱스
+
+        Returns:
+            (too_short, too_long): 길이 < min_len, 길이 > max_len 인 레코드 인덱스 배열
+        """
+        values = self.lengths(field, metric)
+        empty = np.empty(0, dtype=np.int64)
+        too_short = np.flatnonzero(values < min_len) if min_len is not None else empty
+        too_long = np.flatnonzero(values > max_len) if max_len is not None else empty
+        return too_short, too_long
+
+    def to_dict(self, thresholds=None):
+        """전체 프로파일 (JSON 직렬화 가능)
+
+        Args:
+            thresholds: {field: (min_len, max_len)} - 지정 시 위반 건수/인덱스 포함
+        """
+        result = {'num_records': len(self), 'fields': {}}
+        for field in self.fields:
+            result['fields'][field] = {metric: self.summary(field, metric) for metric in self.metrics}
+            if thresholds and field in thresholds:
+                min_len, max_len = thresholds[field]
+                too_short, too_long = self.violations(field, min_len, max_len)
+                result['fields'][field]['violations'] = {
+                    'min_len': min_len,
+                    'max_len': max_len,
+                    'too_short': too_short.tolist(),
+                    'too_long': too_long.tolist(),
+                }
+        return result
+
+    def save_json(self, output_path, thresholds=None):
+        output_path = Path(output_path)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(thresholds), f, ensure_ascii=False, indent=2)
+        return output_path
@@ -0,0 +1,882 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+HIRA 학습 데이터셋 공용 모듈
+- 프롬프트 형식 (02_train_with_validation.py / train_solar)
+- 1회 토큰화 후 memory-mapped NumPy 캐시 (input_ids, 길이, 프롬프트 길이)
+- 캐시 키: 토크나이저 지문 + 프롬프트 형식 + max_length + 데이터 파일
+- 캐시 생성은 파일 잠금으로 한 프로세스만 (torchrun rank 들은 생성이 끝나면 불러옴)
+- 배치 내 최장 길이 동적 패딩 + 길이 버킷 배치 샘플러
+- 짧은 샘플 여러 개를 max_length 한 행으로 묶는 packing (block-diagonal attention)
+- 캐시 없이 collate_fn 에서 마이크로배치 단위로 토큰화하는 원문 데이터셋
+- 대용량 JSONL 샤드 스트리밍 (워커 / rank 별 파일·바이트 구간 분할, 셔플 버퍼, 워커 내 토큰화)
+- 평가 세트: 길이 층화 부분 표본, 배치 텐서 캐시
+"""
+
+import bisect
+import fcntl
+import hashlib
+import json
+import math
+import os
+import shutil
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info
+
+from jsonl_io import count_jsonl_lines, iter_jsonl, iter_jsonl_range, load_jsonl
+
+# 토큰화 배치 크기 (fast tokenizer 병렬 처리 단위)
+TOKENIZE_BATCH_SIZE = 1000
+# 스트리밍 워커에서 한 번에 토큰화하는 샘플 수 (첫 배치 지연과 균형)
+STREAM_TOKENIZE_BATCH_SIZE = 64
+CACHE_VERSION = 2
+
+
+# ============================================
+# 프롬프트 형식
+# ============================================
+def format_instruction_prompt(sample):
+    """02_train_with_validation.py 형식: (프롬프트, 응답)"""
+    instruction = sample['instruction'].strip()
+    output = sample['output'].strip()
+    return f"### Instruction:\n{instruction}\n\n### Response:\n", output
+
+
+def format_solar_prompt(sample):
+    """train_solar 형식 (Input 포함): (프롬프트, 응답)"""
+    prompt = f"""### Instruction:
+{sample.get('instruction', '')}
+
+### Input:
+{sample.get('input', '')}
+
+### Response:
+"""
+    return prompt, sample.get('output', '')
+
+
+def prompt_signature(prompt_fn):
+    """캐시 키용 프롬프트 형식 식별 문자열"""
+    prompt, response = prompt_fn({'instruction': '{instruction}', 'input': '{input}', 'output': '{output}'})
+    return prompt + response
+
+
+# ============================================
+# 응답 전용 레이블 (프롬프트 길이)
+# ============================================
+def tokenize_with_prompt_lens(tokenizer, batch, max_length):
+    """(프롬프트, 응답) 배치를 토큰화하고 샘플별 프롬프트 토큰 수를 함께 반환
+
+    fast tokenizer 는 offset mapping 으로 한 번에 계산한다: 응답 문자를
+    하나라도 포함하는 첫 토큰이 응답 시작 (경계에 걸친 토큰은 응답 쪽 → 레이블에 포함).
+    그 외에는 프롬프트만 따로 토큰화한 길이를 사용한다.
+
+    Returns:
+        (input_ids 리스트, prompt_lens 리스트)
+    """
+    prompts = [p for p, _ in batch]
+    texts = [p + r for p, r in batch]
+
+    if not getattr(tokenizer, 'is_fast', False):
+        encoded = tokenizer(texts, truncation=True, max_length=max_length)['input_ids']
+        prompt_encoded = tokenizer(prompts, truncation=True, max_length=max_length)['input_ids']
+        return encoded, [len(ids) for ids in prompt_encoded]
+
+    encoded = tokenizer(texts, truncation=True, max_length=max_length, return_offsets_mapping=True)
+    prompt_lens = []
+    for prompt, offsets in zip(prompts, encoded['offset_mapping']):
+        # 특수 토큰은 (0, 0) 이라 응답 토큰으로 잡히지 않는다
+        ends = np.asarray(offsets, dtype=np.int64).reshape(-1, 2)[:, 1]
+        in_response = ends > len(prompt)
+        prompt_lens.append(int(in_response.argmax()) if in_response.any() else len(ends))
+    return encoded['input_ids'], prompt_lens
+
+
+def build_labels(input_ids, prompt_len, length, start=0, mask_prompt=True, mask_padding=True):
+    """input_ids 에서 레이블 생성 (프롬프트 / 패딩 = -100, 텐서 슬라이싱만 사용)
+
+    Args:
+        prompt_len: 프롬프트 토큰 수 (캐시의 prompt_lens)
+        length: 실제 토큰 수
+        start: 실제 토큰 시작 위치 (왼쪽 패딩이면 패딩 길이)
+    """
+    labels = input_ids.clone()
+    if mask_padding:
+        labels[:start] = -100
+        labels[start + length:] = -100
+    # 잘림으로 응답이 모두 사라졌으면 (prompt_len >= length) 전체 마스킹 → 프롬프트는 학습하지 않음
+    if mask_prompt:
+        labels[start:start + min(prompt_len, length)] = -100
+    return labels
+
+
+# ============================================
+# 토큰 캐시
+# ============================================
+def tokenizer_fingerprint(tokenizer):
+    """토크나이저 지문 (어휘, 정규화/후처리 규칙, 특수 토큰)
+
+    backend 직렬화에는 마지막 호출의 truncation / padding 상태가 들어 있어
+    (tokenizer(..., truncation=True, max_length=...) 호출 순서에 따라 바뀜)
+    두 항목을 비우고 해시한다.
+    """
+    h = hashlib.sha256()
+    h.update(type(tokenizer).__name__.encode('utf-8'))
+    backend = getattr(tokenizer, 'backend_tokenizer', None)
+    if backend is not None:
+        state = json.loads(backend.to_str())
+        state['truncation'] = None
+        state['padding'] = None
+        h.update(json.dumps(state, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    else:
+        h.update(json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False).encode('utf-8'))
+    h.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str).encode('utf-8'))
+    return h.hexdigest()
+
+
+def file_fingerprint(file_path):
+    """데이터 파일 식별 (경로 + 크기 + 수정 시각)"""
+    stat = Path(file_path).stat()
+    return f"{Path(file_path).resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def cache_key(file_path, tokenizer, prompt_fn, max_length):
+    h = hashlib.sha256()
+    for part in (str(CACHE_VERSION), tokenizer_fingerprint(tokenizer), prompt_signature(prompt_fn),
+                 str(max_length), file_fingerprint(file_path)):
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()[:16]
+
+
+@contextmanager
+def _file_lock(lock_path):
+    """프로세스 간 배타 잠금 (같은 캐시를 동시에 만들지 않도록)"""
+    with open(lock_path, 'w') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print(f"⏳ 다른 프로세스가 토큰 캐시 생성 중 - 대기 ({Path(lock_path).name})")
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class TokenCache:
+    """memory-mapped 토큰 캐시
+
+    input_ids 는 모든 샘플을 이어 붙인 1차원 배열이고, offsets[i]:offsets[i+1]
+    가 i번째 샘플이다. prompt_lens[i] 는 응답 시작 위치 (레이블 마스킹용).
+    np.load(mmap_mode='r') 로 열기 때문에 DataLoader 워커들이 페이지를 공유한다.
+    """
+
+    FILES = ('input_ids', 'offsets', 'prompt_lens')
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+        self.input_ids = np.load(self.cache_dir / 'input_ids.npy', mmap_mode='r')
+        self.offsets = np.load(self.cache_dir / 'offsets.npy', mmap_mode='r')
+        self.prompt_lens = np.load(self.cache_dir / 'prompt_lens.npy', mmap_mode='r')
+        with open(self.cache_dir / 'meta.json', 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        """샘플별 토큰 수"""
+        return np.diff(self.offsets)
+
+    def tokens(self, idx):
+        """i번째 샘플 토큰 (memmap 뷰, 복사 없음)"""
+        return self.input_ids[self.offsets[idx]:self.offsets[idx + 1]]
+
+    @staticmethod
+    def exists(cache_dir):
+        cache_dir = Path(cache_dir)
+        return all((cache_dir / f"{name}.npy").exists() for name in TokenCache.FILES) and \
+            (cache_dir / 'meta.json').exists()
+
+    @classmethod
+    def build(cls, cache_dir, records, tokenizer, prompt_fn, max_length, meta=None):
+        """레코드를 배치 토큰화하여 캐시 생성 (임시 디렉토리에 쓴 뒤 rename)"""
+        cache_dir = Path(cache_dir)
+        tmp_dir = cache_dir.with_name(cache_dir.name + f".tmp{os.getpid()}")
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir)
+        tmp_dir.mkdir(parents=True)
+
+        ids_chunks, lengths, prompt_lens = [], [], []
+        batch = []
+
+        def flush():
+            encoded, batch_prompt_lens = tokenize_with_prompt_lens(tokenizer, batch, max_length)
+            for ids, prompt_len in zip(encoded, batch_prompt_lens):
+                ids_chunks.append(np.asarray(ids, dtype=np.int32))
+                lengths.append(len(ids))
+                prompt_lens.append(prompt_len)
+            batch.clear()
+
+        for record in records:
+            batch.append(prompt_fn(record))
+            if len(batch) >= TOKENIZE_BATCH_SIZE:
+                flush()
+        if batch:
+            flush()
+
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        input_ids = np.concatenate(ids_chunks) if ids_chunks else np.zeros(0, dtype=np.int32)
+
+        np.save(tmp_dir / 'input_ids.npy', input_ids)
+        np.save(tmp_dir / 'offsets.npy', offsets)
+        np.save(tmp_dir / 'prompt_lens.npy', np.asarray(prompt_lens, dtype=np.int32))
+        with open(tmp_dir / 'meta.json', 'w', encoding='utf-8') as f:
+            json.dump(dict(meta or {}, num_samples=len(lengths), num_tokens=int(offsets[-1]),
+                           max_length=max_length), f, ensure_ascii=False, indent=2)
+
+        if cache_dir.exists():
+            shutil.rmtree(cache_dir)
+        tmp_dir.rename(cache_dir)
+        return cls(cache_dir)
+
+    @classmethod
+    def load_or_build(cls, file_path, tokenizer, prompt_fn, max_length, cache_root):
+        key = cache_key(file_path, tokenizer, prompt_fn, max_length)
+        cache_dir = Path(cache_root) / f"{Path(file_path).stem}-{key}"
+        if cls.exists(cache_dir):
+            return cls(cache_dir)
+        # torchrun rank 등 여러 프로세스: 하나만 생성하고 나머지는 잠금이 풀린 뒤 불러옴
+        cache_dir.parent.mkdir(parents=True, exist_ok=True)
+        with _file_lock(cache_dir.with_name(cache_dir.name + '.lock')):
+            if cls.exists(cache_dir):
+                return cls(cache_dir)
+            meta = {'source': str(file_path), 'key': key, 'prompt': prompt_signature(prompt_fn)}
+            return cls.build(cache_dir, iter_jsonl(file_path), tokenizer, prompt_fn, max_length, meta)
+
+
+# ============================================
+# Dataset
+# ============================================
+class HIRADataset(Dataset):
+    """HIRA 건강보험 데이터셋 (토큰 캐시 기반)
+
+    토큰화는 캐시 생성 시 한 번만 수행하고, __getitem__ 은 memmap 슬라이스를
+    max_length 로 패딩만 한다. padding='longest' 이면 패딩 없이 반환하고
+    DynamicPaddingCollator 가 배치 단위로 패딩한다.
+
+    packing=True 이면 여러 샘플을 한 행(최대 max_length)으로 묶고, 행마다
+    position_ids 와 segment_ids 를 함께 반환한다. 이 경우 항상 패딩 없이
+    반환하며 DynamicPaddingCollator 가 block-diagonal attention mask 를 만든다.
+    """
+
+    def __init__(self, file_path, tokenizer, max_length=512, prompt_fn=format_instruction_prompt,
+                 cache_dir=None, mask_prompt=True, mask_padding=True, padding='max_length', packing=False):
+        """
+        Args:
+            file_path: 학습 JSONL 경로
+            prompt_fn: 샘플 → (프롬프트, 응답) 함수
+            cache_dir: 토큰 캐시 루트 (기본: 데이터 파일 옆 .token_cache)
+            mask_prompt: 프롬프트 부분 레이블을 -100 으로 (응답만 학습)
+            mask_padding: 패딩 부분 레이블을 -100 으로
+            padding: 'max_length' (고정 길이) 또는 'longest' (collate 에서 동적 패딩)
+            packing: 여러 샘플을 max_length 행으로 묶기
+        """
+        self.file_path = Path(file_path)
+        self.max_length = max_length
+        self.mask_prompt = mask_prompt
+        self.mask_padding = mask_padding
+        self.padding = padding
+        self.packing = packing
+        self.pad_token_id = tokenizer.pad_token_id
+        self.padding_side = tokenizer.padding_side
+
+        cache_root = Path(cache_dir) if cache_dir is not None else self.file_path.parent / ".token_cache"
+        self.cache = TokenCache.load_or_build(self.file_path, tokenizer, prompt_fn, max_length, cache_root)
+
+        print(f"📂 Loaded {len(self.cache)} examples from {self.file_path.name} (cache: {self.cache.cache_dir.name})")
+
+        self.packs = None
+        if packing:
+            self.packs = pack_sequences(self.cache.lengths, max_length)
+            print(f"  📦 Packing: {len(self.cache)}개 → {len(self.packs)}행 "
+                  f"(평균 {len(self.cache) / max(len(self.packs), 1):.1f}개/행)")
+
+    def __len__(self):
+        return len(self.packs) if self.packs is not None else len(self.cache)
+
+    @property
+    def lengths(self):
+        """샘플(또는 packing 행)별 토큰 수 (길이 버킷 샘플러용)"""
+        lengths = self.cache.lengths
+        if self.packs is not None:
+            return np.array([lengths[pack].sum() for pack in self.packs], dtype=np.int64)
+        return lengths
+
+    def _labels(self, tokens, idx):
+        """패딩 없는 샘플의 응답 전용 레이블"""
+        return build_labels(tokens, int(self.cache.prompt_lens[idx]), tokens.numel(), mask_prompt=self.mask_prompt)
+
+    def _packed_item(self, pack):
+        input_ids, labels, position_ids, segment_ids = [], [], [], []
+        for segment, idx in enumerate(pack):
+            tokens = torch.from_numpy(self.cache.tokens(idx).astype(np.int64))
+            length = tokens.numel()
+            sample_labels = self._labels(tokens, idx)
+            # 이전 샘플 마지막 토큰 → 이 샘플 첫 토큰 예측은 학습하지 않음
+            sample_labels[0] = -100
+            input_ids.append(tokens)
+            labels.append(sample_labels)
+            position_ids.append(torch.arange(length))
+            segment_ids.append(torch.full((length,), segment, dtype=torch.long))
+
+        input_ids = torch.cat(input_ids)
+        return {
+            'input_ids': input_ids,
+            'attention_mask': torch.ones(input_ids.numel(), dtype=torch.long),
+            'labels': torch.cat(labels),
+            'position_ids': torch.cat(position_ids),
+            'segment_ids': torch.cat(segment_ids)
+        }
+
+    def __getitem__(self, idx):
+        if self.packs is not None:
+            return self._packed_item(self.packs[idx])
+
+        tokens = torch.from_numpy(self.cache.tokens(idx).astype(np.int64))
+        length = tokens.numel()
+
+        if self.padding == 'longest':
+            return {
+                'input_ids': tokens,
+                'attention_mask': torch.ones(length, dtype=torch.long),
+                'labels': self._labels(tokens, idx)
+            }
+
+        input_ids = torch.full((self.max_length,), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros(self.max_length, dtype=torch.long)
+        start = 0 if self.padding_side == 'right' else self.max_length - length
+        input_ids[start:start + length] = tokens
+        attention_mask[start:start + length] = 1
+
+        return {
+            'input_ids': input_ids,
+            'attention_mask': attention_mask,
+            'labels': build_labels(input_ids, int(self.cache.prompt_lens[idx]), length, start,
+                                   self.mask_prompt, self.mask_padding)
+        }
+
+
+# ============================================
+# Packing
+# ============================================
+def pack_sequences(lengths, max_length):
+    """샘플을 max_length 행에 best-fit decreasing 으로 배치
+
+    Returns:
+        행별 샘플 인덱스 리스트 (행 안은 원래 인덱스 순)
+    """
+    lengths = np.asarray(lengths)
+    order = np.argsort(-lengths, kind='stable')
+
+    packs = []
+    # 남은 공간 오름차순 (remaining, pack_id) - 들어갈 수 있는 가장 작은 공간 선택
+    free = []
+    for idx in order.tolist():
+        length = int(lengths[idx])
+        pos = bisect.bisect_left(free, (length, -1))
+        if pos < len(free):
+            remaining, pack_id = free.pop(pos)
+        else:
+            remaining, pack_id = max_length, len(packs)
+            packs.append([])
+        packs[pack_id].append(idx)
+        remaining -= length
+        if remaining > 0:
+            bisect.insort(free, (remaining, pack_id))
+
+    return [sorted(pack) for pack in packs]
+
+
+def block_diagonal_mask(segment_ids, dtype=torch.float32):
+    """packing 행의 4D additive attention mask (batch, 1, L, L)
+
+    같은 segment 안에서만 causal attention 을 허용한다. 패딩(segment -1)
+    행은 전부 막히지만 -inf 대신 dtype 최소값이라 NaN 이 생기지 않는다.
+    """
+    length = segment_ids.shape[1]
+    same_segment = segment_ids.unsqueeze(2) == segment_ids.unsqueeze(1)
+    causal = torch.ones(length, length, dtype=torch.bool).tril()
+    allowed = same_segment & causal & (segment_ids >= 0).unsqueeze(1)
+    mask = torch.zeros(allowed.shape, dtype=dtype)
+    mask.masked_fill_(~allowed, torch.finfo(dtype).min)
+    return mask.unsqueeze(1)
+
+
+# ============================================
+# 동적 패딩 / 길이 버킷 샘플러
+# ============================================
+class DynamicPaddingCollator:
+    """배치 내 최장 시퀀스 길이로 패딩하는 collate_fn
+
+    packing 샘플(position_ids/segment_ids 포함)은 오른쪽 패딩 후
+    block-diagonal 4D attention mask 를 만든다 (mask_dtype 은 모델 dtype).
+    block_mask=False 이면 4D mask 대신 2D 패딩 mask 를 넣고, 샘플 경계는
+    position_ids / segment_ids 로만 구분한다 (경계 처리는 attention 구현 몫).
+    attention_mask 는 항상 포함된다.
+    """
+
+    def __init__(self, pad_token_id, padding_side='right', mask_padding=True, pad_to_multiple_of=None,
+                 mask_dtype=torch.float32, block_mask=True):
+        self.pad_token_id = pad_token_id
+        self.padding_side = padding_side
+        self.mask_padding = mask_padding
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.mask_dtype = mask_dtype
+        self.block_mask = block_mask
+
+    def __call__(self, features):
+        max_len = max(f['input_ids'].numel() for f in features)
+        if self.pad_to_multiple_of:
+            max_len = math.ceil(max_len / self.pad_to_multiple_of) * self.pad_to_multiple_of
+
+        packed = 'segment_ids' in features[0]
+        padding_side = 'right' if packed else self.padding_side
+
+        batch_size = len(features)
+        input_ids = torch.full((batch_size, max_len), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((batch_size, max_len), dtype=torch.long)
+        labels = torch.full((batch_size, max_len), -100, dtype=torch.long)
+        if packed:
+            position_ids = torch.zeros((batch_size, max_len), dtype=torch.long)
+            segment_ids = torch.full((batch_size, max_len), -1, dtype=torch.long)
+
+        for i, f in enumerate(features):
+            length = f['input_ids'].numel()
+            span = slice(0, length) if padding_side == 'right' else slice(max_len - length, max_len)
+            input_ids[i, span] = f['input_ids']
+            attention_mask[i, span] = f['attention_mask']
+            labels[i, span] = f['labels']
+            if packed:
+                position_ids[i, span] = f['position_ids']
+                segment_ids[i, span] = f['segment_ids']
+
+        if not self.mask_padding:
+            # 기존 02 동작: 패딩 위치도 input_ids 를 레이블로 사용
+            labels = torch.where(attention_mask.bool(), labels, input_ids)
+
+        if not packed:
+            return {'input_ids': input_ids, 'attention_mask': attention_mask, 'labels': labels}
+
+        if self.block_mask:
+            attention_mask = block_diagonal_mask(segment_ids, self.mask_dtype)
+        else:
+            attention_mask = (segment_ids >= 0).long()
+        return {'input_ids': input_ids, 'attention_mask': attention_mask, 'labels': labels,
+                'position_ids': position_ids, 'segment_ids': segment_ids}
+
+
+class LengthBucketSampler(Sampler):
+    """비슷한 길이끼리 배치를 묶는 batch_sampler
+
+    매 epoch 전체 인덱스를 섞은 뒤 batch_size * bucket_multiplier 크기의 구간
+    안에서만 길이순 정렬하고, 만들어진 배치 순서를 다시 섞는다.
+    → 패딩은 줄이면서 epoch 단위 무작위성은 유지.
+
+    num_replicas > 1 (데이터 병렬): 모든 rank 가 같은 seed 로 같은 배치 목록을
+    만들고 rank 번째부터 num_replicas 개 간격으로 가져간다. even_shards=True 면
+    rank 마다 배치 수를 같게 맞추려고 남는 배치를 버린다 (학습 - rank 별 step 수가
+    다르면 gradient all-reduce 가 멈춤). 평가는 False 로 전체를 나눠 읽는다.
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_multiplier=50, seed=42, drop_last=False,
+                 num_replicas=1, rank=0, even_shards=True):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = batch_size * bucket_multiplier
+        self.seed = seed
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.even_shards = even_shards
+        self.epoch = 0
+        self.start_batch = 0
+
+    def set_epoch(self, epoch, start_batch=0):
+        """epoch 지정 (start_batch: 재개 시 이미 학습한 배치 수 - 그만큼 건너뜀)"""
+        self.epoch = epoch
+        self.start_batch = start_batch
+
+    def _split(self, bucket):
+        """길이순 정렬된 구간을 배치로 분할"""
+        for b in range(0, len(bucket), self.batch_size):
+            batch = bucket[b:b + self.batch_size]
+            if self.drop_last and len(batch) < self.batch_size:
+                continue
+            yield batch.tolist()
+
+    def _shard_size(self, total):
+        """전체 배치 수 total 중 이 rank 가 받는 수"""
+        if self.even_shards:
+            return total // self.num_replicas
+        return len(range(self.rank, total, self.num_replicas))
+
+    def _batches(self, epoch=None):
+        """이 rank 의 배치 목록"""
+        batches = self._all_batches(epoch)
+        if self.num_replicas == 1:
+            return batches
+        return batches[self.rank::self.num_replicas][:self._shard_size(len(batches))]
+
+    def _all_batches(self, epoch=None):
+        """전체 배치 목록 (모든 rank 공통)"""
+        epoch = self.epoch if epoch is None else epoch
+        rng = np.random.default_rng(self.seed + epoch)
+        indices = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = indices[start:start + self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            batches.extend(self._split(bucket))
+
+        if self.shuffle:
+            order = rng.permutation(len(batches))
+            batches = [batches[i] for i in order]
+        return batches
+
+    def __iter__(self):
+        start_batch, self.start_batch = self.start_batch, 0
+        yield from self._batches()[start_batch:]
+        # 다음 epoch 에 다른 순서 (set_epoch 를 호출하지 않는 루프 대비)
+        self.epoch += 1
+
+    def __len__(self):
+        return self.num_batches(self.epoch) - self.start_batch
+
+    def num_batches(self, epoch):
+        """해당 epoch 에 이 rank 가 받는 배치 수 (스케줄러 총 스텝 계산용)"""
+        if self.drop_last:
+            total = sum(len(self.lengths[i:i + self.bucket_size]) // self.batch_size
+                        for i in range(0, len(self.lengths), self.bucket_size))
+        else:
+            total = sum(math.ceil(len(self.lengths[i:i + self.bucket_size]) / self.batch_size)
+                        for i in range(0, len(self.lengths), self.bucket_size))
+        return self._shard_size(total)
+
+
+class TokenBudgetSampler(LengthBucketSampler):
+    """배치 크기 대신 (패딩 포함) 토큰 수 상한으로 배치를 만드는 batch_sampler
+
+    길이순 정렬된 구간을 앞에서부터 채우며, 배치 샘플 수 × 배치 최장 길이가
+    max_tokens 를 넘기 직전에 자른다. 짧은 샘플은 큰 배치, 긴 샘플은 작은
+    배치가 되어 GPU 사용량이 일정해진다. 배치 수가 epoch 마다 조금씩 다르다.
+    """
+
+    def __init__(self, lengths, max_tokens, shuffle=True, bucket_size=2000, seed=42, max_batch_size=None,
+                 num_replicas=1, rank=0, even_shards=True):
+        super().__init__(lengths, batch_size=1, shuffle=shuffle, seed=seed,
+                         num_replicas=num_replicas, rank=rank, even_shards=even_shards)
+        self.max_tokens = max_tokens
+        self.bucket_size = bucket_size
+        self.max_batch_size = max_batch_size
+
+    def _split(self, bucket):
+        batch, longest = [], 0
+        for idx in bucket.tolist():
+            length = int(self.lengths[idx])
+            size = len(batch) + 1
+            over_budget = size * max(longest, length) > self.max_tokens
+            over_size = self.max_batch_size is not None and size > self.max_batch_size
+            if batch and (over_budget or over_size):
+                yield batch
+                batch, longest = [], 0
+            batch.append(idx)
+            longest = max(longest, length)
+        if batch:
+            yield batch
+
+    def num_batches(self, epoch):
+        return len(self._batches(epoch))
+
+
+class PaddingMeter:
+    """패딩 효율 (실제 토큰 / 배치 전체 토큰) 집계"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.real_tokens = 0
+        self.total_tokens = 0
+
+    def update(self, batch):
+        """배치 집계 (packing 배치는 segment_ids 로 실제 토큰 판별)"""
+        if 'segment_ids' in batch:
+            real = batch['segment_ids'] >= 0
+        else:
+            real = batch['attention_mask']
+        self.real_tokens += int(real.sum())
+        self.total_tokens += real.numel()
+
+    @property
+    def efficiency(self):
+        return self.real_tokens / self.total_tokens if self.total_tokens else 0.0
+
+
+# ============================================
+# 실시간 배치 토큰화 (캐시 없이)
+# ============================================
+class RawTextDataset(Dataset):
+    """(프롬프트, 응답) 원문만 반환하는 데이터셋
+
+    토큰화는 TokenizingCollator 가 마이크로배치 전체를 한 번에 수행한다
+    (fast tokenizer 의 배치 병렬 처리 사용). 캐시를 만들 수 없거나
+    데이터가 자주 바뀌는 경우용.
+    """
+
+    def __init__(self, file_path, prompt_fn=format_instruction_prompt):
+        self.file_path = Path(file_path)
+        self.samples = [prompt_fn(record) for record in load_jsonl(self.file_path)]
+        print(f"📂 Loaded {len(self.samples)} examples from {self.file_path.name} (raw text)")
+
+    def __len__(self):
+        return len(self.samples)
+
+    @property
+    def lengths(self):
+        """샘플별 문자 수 (토큰 수 대용, 길이 버킷 샘플러용)"""
+        return np.array([len(p) + len(r) for p, r in self.samples], dtype=np.int64)
+
+    def __getitem__(self, idx):
+        return self.samples[idx]
+
+
+class TokenizingCollator:
+    """(프롬프트, 응답) 배치를 한 번의 토크나이저 호출로 토큰화 + 패딩 + 레이블 마스킹"""
+
+    def __init__(self, tokenizer, max_length=512, mask_prompt=True, mask_padding=True, pad_to_multiple_of=None):
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.mask_prompt = mask_prompt
+        self.padder = DynamicPaddingCollator(tokenizer.pad_token_id, tokenizer.padding_side,
+                                             mask_padding=mask_padding, pad_to_multiple_of=pad_to_multiple_of)
+
+    def __call__(self, batch):
+        encoded, prompt_lens = tokenize_with_prompt_lens(self.tokenizer, batch, self.max_length)
+        features = []
+        for ids, prompt_len in zip(encoded, prompt_lens):
+            tokens = torch.tensor(ids, dtype=torch.long)
+            features.append({
+                'input_ids': tokens,
+                'attention_mask': torch.ones(tokens.numel(), dtype=torch.long),
+                'labels': build_labels(tokens, prompt_len, tokens.numel(), mask_prompt=self.mask_prompt)
+            })
+        return self.padder(features)
+
+
+def dataloader_kwargs(num_workers=0, pin_memory=False, prefetch_factor=2, seed=None):
+    """DataLoader 워커 설정
+
+    워커가 있으면 epoch 마다 다시 띄우지 않도록 persistent_workers 를 켜고
+    prefetch_factor 만큼 배치를 미리 준비한다 (워커 0 이면 두 옵션 모두 사용 불가).
+    seed 를 주면 DataLoader 전용 generator 를 써서 이터레이터 생성이 전역
+    torch RNG (dropout 등) 를 소비하지 않는다 → 학습 재개 시 RNG 재현.
+    """
+    kwargs = {'num_workers': num_workers, 'pin_memory': pin_memory}
+    if seed is not None:
+        kwargs['generator'] = torch.Generator().manual_seed(seed)
+    if num_workers > 0:
+        kwargs.update(persistent_workers=True, prefetch_factor=prefetch_factor)
+    return kwargs
+
+
+# ============================================
+# 스트리밍 (대용량 코퍼스)
+# ============================================
+def expand_shards(paths):
+    """파일 / 디렉터리 / glob 패턴 (또는 그 리스트) → 정렬된 JSONL 파일 목록"""
+    if isinstance(paths, (str, Path)):
+        paths = [paths]
+    files = []
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            files.extend(sorted(f for f in path.iterdir() if '.jsonl' in f.name))
+        elif any(c in str(path) for c in '*?['):
+            files.extend(sorted(path.parent.glob(path.name)))
+        else:
+            files.append(path)
+    if not files:
+        raise FileNotFoundError(f"JSONL 샤드 없음: {paths}")
+    return files
+
+
+def shuffle_buffer(items, buffer_size, rng):
+    """크기 buffer_size 버퍼에서 무작위로 꺼내는 근사 셔플 (메모리 = 버퍼 크기)"""
+    buffer = []
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        i = int(rng.integers(buffer_size))
+        yield buffer[i]
+        buffer[i] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+class StreamingHIRADataset(IterableDataset):
+    """JSONL 샤드를 순차로 읽으며 워커 안에서 토큰화하는 IterableDataset
+
+    전체 데이터를 메모리에 올리지 않는다. 분할 단위는 (rank, 워커) 쌍이다:
+    파일 수가 분할 수 이상이면 파일 단위, 적으면 각 비압축 파일을 바이트
+    구간으로 나눠 중복 / 누락 없이 읽는다. 읽은 (프롬프트, 응답) 은 셔플 버퍼를
+    거쳐 작은 배치로 토큰화되고, HIRADataset(padding='longest') 와 같은 형식
+    (응답 전용 레이블) 으로 나온다 → DynamicPaddingCollator 로 배치.
+
+    epoch 마다 셔플 순서가 바뀐다: persistent 워커는 __iter__ 마다 자체
+    epoch 를 올리고, 그 외에는 set_epoch() 값을 쓴다.
+    """
+
+    def __init__(self, paths, tokenizer, max_length=512, prompt_fn=format_instruction_prompt,
+                 shuffle_buffer_size=10000, seed=42, mask_prompt=True, rank=None, world_size=None):
+        self.files = expand_shards(paths)
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.prompt_fn = prompt_fn
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.mask_prompt = mask_prompt
+        if rank is None and torch.distributed.is_available() and torch.distributed.is_initialized():
+            rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+        self.rank = rank or 0
+        self.world_size = world_size or 1
+        self.epoch = 0
+        self._num_samples = None
+
+        print(f"📂 Streaming {len(self.files)}개 샤드 (rank {self.rank}/{self.world_size}, "
+              f"셔플 버퍼 {shuffle_buffer_size})")
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    @property
+    def num_samples(self):
+        """전체 샘플 수 추정 (줄 수, 스케줄러 step 계산용 - 최초 1회 스캔)"""
+        if self._num_samples is None:
+            self._num_samples = sum(count_jsonl_lines(f) for f in self.files)
+        return self._num_samples
+
+    def estimate_batches(self, batch_size, num_workers=0):
+        """이 rank 의 epoch 당 배치 수 추정 (워커마다 마지막 배치가 덜 찰 수 있음)"""
+        per_rank = math.ceil(self.num_samples / self.world_size)
+        return math.ceil(per_rank / batch_size) + max(num_workers - 1, 0)
+
+    def _shard(self):
+        info = get_worker_info()
+        num_workers, worker_id = (info.num_workers, info.id) if info is not None else (1, 0)
+        return self.rank * num_workers + worker_id, self.world_size * num_workers
+
+    def _assignments(self, shard, num_shards, epoch):
+        """이 분할이 읽을 (파일, 시작, 끝) 목록 - 파일 순서는 epoch 별 (모든 분할 공통)"""
+        files = [self.files[i] for i in np.random.default_rng(self.seed + epoch).permutation(len(self.files))]
+        if len(files) >= num_shards:
+            return [(f, 0, None) for f in files[shard::num_shards]]
+
+        assignments = []
+        for i, f in enumerate(files):
+            if f.suffix.lower() in ('.gz', '.zst'):
+                # 압축 파일은 구간 탐색 불가 → 파일 단위
+                if i % num_shards == shard:
+                    assignments.append((f, 0, None))
+                continue
+            size = f.stat().st_size
+            assignments.append((f, size * shard // num_shards, size * (shard + 1) // num_shards))
+        return assignments
+
+    def _samples(self, assignments):
+        for f, start, end in assignments:
+            records = iter_jsonl(f, report=False) if end is None else iter_jsonl_range(f, start, end)
+            for record in records:
+                yield self.prompt_fn(record)
+
+    def _tokenize(self, batch):
+        encoded, prompt_lens = tokenize_with_prompt_lens(self.tokenizer, batch, self.max_length)
+        for ids, prompt_len in zip(encoded, prompt_lens):
+            tokens = torch.tensor(ids, dtype=torch.long)
+            yield {
+                'input_ids': tokens,
+                'attention_mask': torch.ones(tokens.numel(), dtype=torch.long),
+                'labels': build_labels(tokens, prompt_len, tokens.numel(), mask_prompt=self.mask_prompt)
+            }
+
+    def __iter__(self):
+        # persistent 워커: 다음 __iter__ 는 다음 epoch (중간에 끊겨도)
+        epoch, self.epoch = self.epoch, self.epoch + 1
+        shard, num_shards = self._shard()
+        rng = np.random.default_rng([self.seed, epoch, shard])
+        samples = self._samples(self._assignments(shard, num_shards, epoch))
+        if self.shuffle_buffer_size > 1:
+            samples = shuffle_buffer(samples, self.shuffle_buffer_size, rng)
+
+        batch = []
+        for sample in samples:
+            batch.append(sample)
+            if len(batch) >= STREAM_TOKENIZE_BATCH_SIZE:
+                yield from self._tokenize(batch)
+                batch = []
+        if batch:
+            yield from self._tokenize(batch)
+
+
+# ============================================
+# 평가 세트
+# ============================================
+def stratified_subsample(lengths, size, num_strata=10, seed=42):
+    """길이 분포를 유지하는 고정 부분 표본 인덱스
+
+    길이순으로 num_strata 개 구간(동일 샘플 수)을 나누고 구간 크기에 비례해
+    비복원 추출한다. 같은 seed 면 항상 같은 표본 → step 간 loss 비교 가능.
+    size 가 None 이거나 전체 이상이면 전체 인덱스.
+    """
+    lengths = np.asarray(lengths)
+    n = len(lengths)
+    if size is None or size >= n:
+        return np.arange(n)
+
+    strata = np.array_split(np.argsort(lengths, kind='stable'), min(num_strata, n))
+    shares = np.array([len(s) for s in strata]) * size / n
+    quotas = np.floor(shares).astype(np.int64)
+    # 남은 표본은 소수점 이하가 큰 구간부터
+    for i in np.argsort(quotas - shares, kind='stable')[:size - quotas.sum()]:
+        quotas[i] += 1
+
+    rng = np.random.default_rng(seed)
+    picks = [rng.choice(s, q, replace=False) for s, q in zip(strata, quotas) if q]
+    return np.sort(np.concatenate(picks))
+
+
+class CachedBatches:
+    """고정 순서 DataLoader 의 배치를 한 번만 만들어 보관 (평가용)
+
+    평가 세트는 매번 같은 배치이므로 토큰화 / 패딩 / 워커 전송을 1회로
+    줄인다. loader 가 pin_memory 면 보관 텐서도 고정 메모리.
+    """
+
+    def __init__(self, loader):
+        self.batches = list(loader)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
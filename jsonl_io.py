@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+공용 JSONL 입출력
+- orjson 사용 가능 시 orjson, 없으면 표준 json
+- 레코드 단위 스트리밍 읽기 (잘못된 줄은 건너뛰고 줄 번호 보고)
+- 바이트 구간 단위 읽기 (워커 / rank 별 분할)
+- .jsonl.gz / .jsonl.zst 자동 압축 해제·압축
+- 배치 단위 버퍼링 쓰기
+"""
+
+import gzip
+import json
+from pathlib import Path
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 한 번에 모아서 쓰는 레코드 수
+WRITE_BATCH_SIZE = 1000
+# 보고 시 출력할 잘못된 줄 번호 개수
+MAX_REPORTED_LINES = 10
+
+
+if orjson is not None:
+    def dumps(obj):
+        """JSON 직렬화 (ensure_ascii=False 와 동일한 출력)"""
+        return orjson.dumps(obj).decode('utf-8')
+
+    def _dumps_bytes(obj):
+        return orjson.dumps(obj)
+
+    loads = orjson.loads
+else:
+    def dumps(obj):
+        """JSON 직렬화 (ensure_ascii=False 와 동일한 출력)"""
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+    def _dumps_bytes(obj):
+        return dumps(obj).encode('utf-8')
+
+    loads = json.loads
+
+
+def open_binary(file_path, mode='rb'):
+    """확장자에 따라 gzip/zstd 를 투명하게 처리하는 바이너리 파일 열기"""
+    file_path = Path(file_path)
+    suffix = file_path.suffix.lower()
+
+    if suffix == '.gz':
+        return gzip.open(file_path, mode)
+    if suffix == '.zst':
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError(".zst 파일을 처리하려면 zstandard 패키지가 필요합니다: pip install zstandard") from e
+        return zstandard.open(file_path, mode)
+    return open(file_path, mode)
+
+
+class ReadStats:
+    """JSONL 읽기 결과 (정상/잘못된 줄 집계)"""
+
+    def __init__(self, file_path):
+        self.file_path = Path(file_path)
+        self.records = 0
+        self.malformed = 0
+        self.malformed_lines = []
+
+    def add_malformed(self, line_no):
+        self.malformed += 1
+        if len(self.malformed_lines) < MAX_REPORTED_LINES:
+            self.malformed_lines.append(line_no)
+
+    def report(self):
+        """잘못된 줄이 있으면 경고 출력"""
+        if not self.malformed:
+            return
+        lines = ', '.join(str(n) for n in self.malformed_lines)
+        more = " ..." if self.malformed > len(self.malformed_lines) else ""
+        print(f"⚠️  {self.file_path.name}: 잘못된 JSON {self.malformed}줄 건너뜀 (line {lines}{more})")
+
+
+def iter_jsonl(file_path, stats=None, report=True):
+    """JSONL 파일을 한 줄씩 읽는 제너레이터
+
+    Args:
+        file_path: .jsonl / .jsonl.gz / .jsonl.zst 경로
+        stats: 집계를 받을 ReadStats (선택)
+        report: 끝까지 읽은 뒤 잘못된 줄 경고 출력 여부
+    """
+    if stats is None:
+        stats = ReadStats(file_path)
+
+    with open_binary(file_path, 'rb') as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = loads(line)
+            except ValueError:  # orjson.JSONDecodeError, UnicodeDecodeError 포함
+                stats.add_malformed(line_no)
+                continue
+            stats.records += 1
+            yield record
+
+    if report:
+        stats.report()
+
+
+def iter_jsonl_range(file_path, start=0, end=None, stats=None):
+    """비압축 JSONL 의 [start, end) 바이트 구간에서 시작하는 줄만 읽는 제너레이터
+
+    구간 경계에 걸친 줄은 시작 위치가 속한 구간이 읽는다 → 파일을 여러
+    구간으로 나눠 읽어도 중복 / 누락이 없다. 잘못된 줄은 바이트 위치로 집계.
+    """
+    if stats is None:
+        stats = ReadStats(file_path)
+
+    with open(file_path, 'rb') as f:
+        if start > 0:
+            # 앞 구간에서 시작한 줄의 나머지 건너뛰기 (start-1 이 개행이면 그대로)
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        while end is None or pos < end:
+            line = f.readline()
+            if not line:
+                break
+            line_start, pos = pos, pos + len(line)
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = loads(line)
+            except ValueError:
+                stats.add_malformed(line_start)
+                continue
+            stats.records += 1
+            yield record
+
+
+def count_jsonl_lines(file_path, chunk_size=1 << 20):
+    """줄 수 (JSON 파싱 없이 개행 수만 스캔, 빈 줄 포함 - 개수 추정용)"""
+    count = 0
+    last = b'\n'
+    with open_binary(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            count += chunk.count(b'\n')
+            last = chunk[-1:]
+    return count + (last != b'\n')  # 마지막 줄에 개행이 없는 경우
+
+
+def load_jsonl(file_path, stats=None, report=True):
+    """JSONL 파일 전체 로드"""
+    return list(iter_jsonl(file_path, stats, report))
+
+
+class JsonlWriter:
+    """배치 버퍼링 JSONL 쓰기 (압축 확장자 자동 처리)"""
+
+    def __init__(self, file_path, append=False, batch_size=WRITE_BATCH_SIZE):
+        self.file_path = Path(file_path)
+        self.batch_size = batch_size
+        self.count = 0
+        self._buffer = []
+        self._file = open_binary(self.file_path, 'ab' if append else 'wb')
+
+    def write(self, record):
+        self._buffer.append(_dumps_bytes(record))
+        self.count += 1
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+
+    def flush(self):
+        if self._buffer:
+            self._buffer.append(b'')
+            self._file.write(b'\n'.join(self._buffer))
+            self._buffer = []
+        self._file.flush()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def save_jsonl(records, file_path, append=False, batch_size=WRITE_BATCH_SIZE):
+    """JSONL 파일 저장, 저장 건수 반환"""
+    with JsonlWriter(file_path, append, batch_size) as writer:
+        writer.write_all(records)
+    return writer.count
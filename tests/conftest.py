@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+CPU 테스트 공용 fixture
+- 작은 BPE 토크나이저 + 2층 Llama (저장소 밖 모델 없이 학습 경로 검증)
+- instruction / output 형식의 작은 train / val / validation JSONL
+"""
+
+import json
+import random
+import sys
+from pathlib import Path
+
+import pytest
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO_ROOT))
+
+TOPICS = ['MRI 검사', '건강보험 진료비', '요양급여 청구', '입원 일수', '외래 방문', '의약품 처방']
+
+
+def make_records(count, seed=0):
+    rng = random.Random(seed)
+    records = []
+    for i in range(count):
+        topic = rng.choice(TOPICS)
+        year = rng.randint(2015, 2024)
+        records.append({
+            'instruction': f"{year}년 {topic} 통계를 알려주세요.",
+            'input': '',
+            'output': f"{year}년 {topic} 건수는 {rng.randint(1, 999)}만건이며 전년 대비 "
+                      f"{rng.randint(1, 30)}% 변했습니다." * rng.randint(1, 3),
+        })
+    return records
+
+
+def write_jsonl(path, records):
+    with open(path, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+@pytest.fixture(scope='session')
+def tiny_model_path(tmp_path_factory):
+    """작은 토크나이저 + 모델 디렉토리 (from_pretrained 로 로드 가능)"""
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from tokenizers.processors import TemplateProcessing
+    from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+    path = tmp_path_factory.mktemp('tiny_model')
+    texts = [text for record in make_records(200) for text in (record['instruction'], record['output'])]
+    texts += ["### Instruction:\n", "### Input:\n", "### Response:\n"]
+
+    backend = Tokenizer(models.BPE(unk_token='<unk>'))
+    backend.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    backend.decoder = decoders.ByteLevel()
+    backend.train_from_iterator(texts, trainers.BpeTrainer(vocab_size=500, special_tokens=['<unk>', '<s>', '</s>']))
+    backend.post_processor = TemplateProcessing(single='<s> $A', special_tokens=[('<s>', 1)])
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=backend, bos_token='<s>', eos_token='</s>',
+                                        unk_token='<unk>')
+    tokenizer.save_pretrained(path)
+
+    config = LlamaConfig(vocab_size=len(tokenizer), hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=512)
+    LlamaForCausalLM(config).save_pretrained(path)
+    return path
+
+
+@pytest.fixture(scope='session')
+def tiny_data_path(tmp_path_factory):
+    """train.jsonl / val.jsonl (02) / validation.jsonl (train_solar)"""
+    path = tmp_path_factory.mktemp('tiny_data')
+    write_jsonl(path / 'train.jsonl', make_records(32, seed=1))
+    val = make_records(10, seed=2)
+    write_jsonl(path / 'val.jsonl', val)
+    write_jsonl(path / 'validation.jsonl', val)
+    return path
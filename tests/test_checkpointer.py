@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""AsyncCheckpointer top-K / 재개 테스트"""
+
+import json
+
+import torch
+
+from train_utils import AsyncCheckpointer, load_training_state
+
+
+class TinyModel(torch.nn.Module):
+    def __init__(self, value):
+        super().__init__()
+        self.weight = torch.nn.Parameter(torch.full((2,), float(value)))
+
+
+def save(output_dir, name, metric, step, resume=False, limit=1):
+    checkpointer = AsyncCheckpointer(output_dir, save_total_limit=limit, resume=resume)
+    checkpointer.save(TinyModel(step), name, metric, step)
+    checkpointer.close()
+    return checkpointer
+
+
+def test_new_run_does_not_rank_against_previous_run(tmp_path):
+    save(tmp_path, 'checkpoint-10', 0.5, 10)
+    checkpointer = save(tmp_path, 'checkpoint-20', 0.9, 20)
+
+    # 새 실행의 체크포인트가 남고 best_model 도 새 실행을 가리킴
+    assert checkpointer.best['name'] == 'checkpoint-20'
+    assert (tmp_path / 'checkpoint-20').exists()
+    assert (tmp_path / 'best_model').resolve() == (tmp_path / 'checkpoint-20').resolve()
+    with open(tmp_path / 'checkpoints.json', encoding='utf-8') as f:
+        assert [c['name'] for c in json.load(f)] == ['checkpoint-20']
+
+    # 이전 실행은 삭제하지 않고 보관 (best_model 링크 포함)
+    archives = list((tmp_path / 'previous_runs').iterdir())
+    assert len(archives) == 1
+    assert (archives[0] / 'checkpoint-10' / 'model.safetensors').exists()
+    assert (archives[0] / 'best_model').resolve() == (archives[0] / 'checkpoint-10').resolve()
+
+
+def test_resume_keeps_ranking(tmp_path):
+    save(tmp_path, 'checkpoint-10', 0.5, 10)
+    checkpointer = save(tmp_path, 'checkpoint-20', 0.9, 20, resume=True)
+
+    assert checkpointer.best['name'] == 'checkpoint-10'
+    assert not (tmp_path / 'checkpoint-20').exists()
+    assert not (tmp_path / 'previous_runs').exists()
+
+
+def test_resume_falls_back_to_old_dir_after_interrupted_replace(tmp_path):
+    checkpointer = AsyncCheckpointer(tmp_path)
+    model = TinyModel(3)
+    checkpointer.save_training_state(model, 'resume_state', {'global_step': 7})
+    checkpointer.close()
+
+    # _replace_dir 의 dst → dst.old rename 직후 중단된 상태
+    (tmp_path / 'resume_state').rename(tmp_path / 'resume_state.old')
+
+    restored = TinyModel(0)
+    state = load_training_state(tmp_path / 'resume_state', restored)
+    assert state['global_step'] == 7
+    assert torch.equal(restored.weight, model.weight)
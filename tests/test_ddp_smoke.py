@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""torchrun 2-rank 데이터 병렬 스모크 테스트 (CPU gloo, 작은 모델)
+
+학습 스크립트를 그대로 실행한다:
+    python -m torch.distributed.run --standalone --nproc_per_node=2 02_train_with_validation.py \\
+        --model-path <tiny> --data-path <data> --output-dir <out> --set num_epochs=1 ...
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+import torch
+
+from conftest import REPO_ROOT
+
+SMALL_CONFIG = ['num_epochs=1', 'max_length=128', 'num_workers=0', 'auto_batch_size=false', 'batch_size=4',
+                'gradient_accumulation_steps=1', 'logging_steps=1']
+
+
+def run_torchrun(script, tiny_model_path, tiny_data_path, output_dir, extra=()):
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='', OMP_NUM_THREADS='1', TOKENIZERS_PARALLELISM='false')
+    command = [sys.executable, '-m', 'torch.distributed.run', '--standalone', '--nproc_per_node=2',
+               str(REPO_ROOT / script), '--model-path', str(tiny_model_path), '--data-path', str(tiny_data_path),
+               '--output-dir', str(output_dir)]
+    for item in list(SMALL_CONFIG) + list(extra):
+        command += ['--set', item]
+    result = subprocess.run(command, cwd=REPO_ROOT, env=env, capture_output=True, text=True, timeout=900)
+    assert result.returncode == 0, result.stdout[-3000:] + result.stderr[-3000:]
+    return result.stdout
+
+
+@pytest.mark.skipif(not torch.distributed.is_available(), reason="torch.distributed 미지원 빌드")
+def test_train_with_validation_two_ranks(tiny_model_path, tiny_data_path, tmp_path):
+    output_dir = tmp_path / 'out'
+    stdout = run_torchrun('02_train_with_validation.py', tiny_model_path, tiny_data_path, output_dir,
+                          extra=['resume_save_steps=2'])
+
+    # 출력 / 파일은 rank 0 만
+    assert stdout.count('Data parallel: 2 ranks (gloo)') == 1
+    assert stdout.count('학습 완료') == 1
+    assert (output_dir / 'final_model' / 'adapter_model.safetensors').exists()
+    with open(output_dir / 'training_history.json', encoding='utf-8') as f:
+        assert len(json.load(f)['val_loss']) == 1
+
+    # 재개 상태: rank 별 RNG / 메트릭, 완료 표시
+    state = torch.load(output_dir / 'resume_state' / 'training_state.pt', weights_only=False)
+    assert len(state['rank_states']) == 2
+    assert state['finished']
+
+
+@pytest.mark.skipif(not torch.distributed.is_available(), reason="torch.distributed 미지원 빌드")
+def test_train_solar_two_ranks(tiny_model_path, tiny_data_path, tmp_path):
+    output_dir = tmp_path / 'out'
+    stdout = run_torchrun('train_solar', tiny_model_path, tiny_data_path, output_dir)
+
+    assert stdout.count('Data parallel: 2 ranks (gloo)') == 1
+    assert (output_dir / 'final_model').exists()
+    assert (output_dir / 'run_config.json').exists()
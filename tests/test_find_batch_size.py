@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""find_batch_size CPU 테스트 (작은 LoRA 모델)"""
+
+import pytest
+import torch
+from peft import LoraConfig, TaskType, get_peft_model
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from hira_dataset import DynamicPaddingCollator, HIRADataset
+from train_utils import causal_lm_loss, find_batch_size, trainable_parameters
+
+
+@pytest.fixture()
+def setup(tiny_model_path, tiny_data_path, tmp_path):
+    torch.manual_seed(0)
+    tokenizer = AutoTokenizer.from_pretrained(tiny_model_path)
+    tokenizer.pad_token = tokenizer.eos_token
+    model = AutoModelForCausalLM.from_pretrained(tiny_model_path)
+    model = get_peft_model(model, LoraConfig(task_type=TaskType.CAUSAL_LM, r=4, lora_alpha=8,
+                                             target_modules=['q_proj', 'v_proj']))
+    dataset = HIRADataset(tiny_data_path / 'train.jsonl', tokenizer, 128, cache_dir=tmp_path / 'cache',
+                          padding='longest')
+    collator = DynamicPaddingCollator(tokenizer.pad_token_id, tokenizer.padding_side)
+
+    def loss_fn(batch):
+        return causal_lm_loss(model, batch['input_ids'], batch['labels'], attention_mask=batch['attention_mask'],
+                              chunk_size=16)
+
+    return model, dataset, collator, loss_fn
+
+
+def test_picks_divisor_and_leaves_model_untouched(setup):
+    model, dataset, collator, loss_fn = setup
+    before = {name: p.detach().clone() for name, p in model.named_parameters()}
+    torch.manual_seed(123)
+    rng_before = torch.get_rng_state()
+
+    result = find_batch_size(model, dataset, collator, 8, loss_fn, 'cpu', probe_steps=2)
+
+    assert result['batch_size'] * result['gradient_accumulation_steps'] == 8
+    assert [p['batch_size'] for p in result['probes']] == [1, 2, 4, 8]
+    assert all(p['status'] == 'ok' for p in result['probes'])
+    # optimizer step 없음, gradient / RNG 원상 복구
+    assert all(torch.equal(p, before[name]) for name, p in model.named_parameters())
+    assert all(p.grad is None for p in trainable_parameters(model))
+    assert torch.equal(torch.get_rng_state(), rng_before)
+
+
+def test_respects_max_batch_size(setup):
+    model, dataset, collator, loss_fn = setup
+    result = find_batch_size(model, dataset, collator, 8, loss_fn, 'cpu', max_batch_size=2, probe_steps=1)
+    assert [p['batch_size'] for p in result['probes']] == [1, 2]
+    assert result['batch_size'] in (1, 2)
+    assert result['gradient_accumulation_steps'] == 8 // result['batch_size']
+
+
+def test_stops_at_first_oom(setup):
+    model, dataset, collator, loss_fn = setup
+
+    def oom_above_two(batch):
+        if batch['input_ids'].shape[0] > 2:
+            raise RuntimeError("CUDA out of memory. Tried to allocate 1.00 GiB")
+        return loss_fn(batch)
+
+    result = find_batch_size(model, dataset, collator, 8, oom_above_two, 'cpu', probe_steps=1)
+    assert [(p['batch_size'], p['status']) for p in result['probes']] == [(1, 'ok'), (2, 'ok'), (4, 'oom')]
+    assert result['batch_size'] in (1, 2)
+    assert all(p.grad is None for p in trainable_parameters(model))
+
+
+def test_non_oom_errors_propagate(setup):
+    model, dataset, collator, _ = setup
+
+    def broken(batch):
+        raise RuntimeError("shape mismatch")
+
+    with pytest.raises(RuntimeError, match="shape mismatch"):
+        find_batch_size(model, dataset, collator, 4, broken, 'cpu')
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+한국어 텍스트 정규화 (중복 판정 키)
+- 유니코드 NFC 정규화 (NFD 로 분해된 한글 결합)
+- 전각 문장부호 / 특수 공백 / 제로폭 문자 변환 테이블
+- 연속 공백 축약, '안녕하세요.' 인사말 접두사와 끝 문장부호 제거
+- 고유 문자열 단위 메모이제이션
+"""
+
+import re
+import unicodedata
+from functools import lru_cache
+
+# 메모이제이션 크기 (고유 문자열 수 기준)
+CANONICAL_CACHE_SIZE = 1 << 17
+
+# 한 번의 str.translate 로 처리하는 문자 치환표
+_TRANSLATION = str.maketrans({
+    '\u200b': None,   # zero width space
+    '\u200c': None,   # zero width non-joiner
+    '\u200d': None,   # zero width joiner
+    '\ufeff': None,   # BOM
+    '\u00a0': ' ',    # no-break space
+    '\u3000': ' ',    # ideographic space
+    '\uff1f': '?',    # ？
+    '\uff01': '!',    # ！
+    '\uff0e': '.',    # ．
+    '\uff0c': ',',    # ，
+    '\uff5e': '~',    # ～
+    '\u201c': '"',
+    '\u201d': '"',
+    '\u2018': "'",
+    '\u2019': "'",
+})
+
+_WHITESPACE = re.compile(r'\s+')
+# _diversify_question / paraphrase_rule_based 가 붙이는 인사말
+_GREETING_PREFIX = re.compile(r'^안녕하세요[.!,~]*\s*')
+_TRAILING_PUNCT = re.compile(r'[?!.~\s]+$')
+
+
+@lru_cache(maxsize=CANONICAL_CACHE_SIZE)
+def canonical_key(text):
+    """중복 판정용 정규화 키
+
+    표기만 다른 같은 문장(NFC/NFD, 공백, 끝의 '?', 인사말 접두사)이
+    같은 키를 갖도록 한다. 학습 데이터 자체를 바꾸는 용도가 아니다.
+    """
+    if not unicodedata.is_normalized('NFC', text):
+        text = unicodedata.normalize('NFC', text)
+    text = text.translate(_TRANSLATION)
+    text = _WHITESPACE.sub(' ', text).strip()
+    text = _GREETING_PREFIX.sub('', text)
+    text = _TRAILING_PUNCT.sub('', text)
+    return text.lower()
@@ -0,0 +1,1066 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+학습 루프 공용 유틸리티 (02_train_with_validation.py / train_solar)
+- gradient accumulation 구간 단위 배치 묶기
+- 토큰 수 기준 loss 정규화
+- 전체 vocab logits 없이 응답 위치만 청크 단위로 계산하는 cross-entropy
+- 스케줄러 총 optimizer step 계산, 명령행 config 덮어쓰기
+- 학습 파라미터 전용 AdamW (no-decay 그룹, fused/foreach, 선택적 CPU 상태 오프로드)
+- 메모리 예산 / 처리량 기준 마이크로배치 크기 + accumulation 자동 탐색
+- step 단위 처리량 / 구간별 시간 계측 (JSONL 기록 + 요약)
+- device 텐서로 누적하고 로깅/평가 시점에만 동기화하는 메트릭 집계
+- 학습 파라미터만 CPU 스냅샷 후 백그라운드 스레드로 저장하는 top-K 체크포인트
+- 학습 재개용 상태 (optimizer / scheduler / 카운터 / RNG / 샘플러 위치)
+- torchrun 데이터 병렬 (nccl / CPU gloo, 학습 파라미터 gradient 만 구간 끝에 all-reduce)
+"""
+
+import json
+import math
+import os
+import random
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+from jsonl_io import JsonlWriter
+
+PROFILE_PHASES = ('data_wait', 'h2d', 'forward', 'backward', 'optimizer')
+
+
+def count_loss_tokens(labels):
+    """loss 에 들어가는 토큰 수 (shift 후 -100 이 아닌 레이블, CPU 텐서에서 계산)"""
+    return int((labels[:, 1:] != -100).sum())
+
+
+def accumulation_windows(batches, accumulation_steps):
+    """배치를 gradient accumulation 구간(최대 accumulation_steps 개)으로 묶는 제너레이터
+
+    구간을 미리 모아야 구간 전체 토큰 수로 loss 를 정규화할 수 있다.
+    epoch 마지막의 짧은 구간도 그대로 반환한다.
+    """
+    window = []
+    for batch in batches:
+        window.append(batch)
+        if len(window) == accumulation_steps:
+            yield window
+            window = []
+    if window:
+        yield window
+
+
+def window_loss_weights(window, token_normalized=True, distributed=False):
+    """구간 내 마이크로배치별 loss 가중치
+
+    token_normalized=True: 배치 loss(토큰 평균) × 배치 토큰 수 / 구간 토큰 수
+        → 구간 전체 토큰 평균 loss 와 같은 gradient (배치 길이가 달라도 스케일 일정)
+    False: 1 / 구간 배치 수 (기존 step 수 기준)
+    distributed=True: 구간 토큰 수를 모든 rank 합으로 (all_reduce_gradients 의
+        rank 평균과 합쳐 전체 rank 토큰 평균 loss 의 gradient)
+    """
+    if not token_normalized:
+        return [1.0 / len(window)] * len(window)
+    tokens = [count_loss_tokens(batch['labels']) for batch in window]
+    total = sum(tokens)
+    scale = 1
+    if distributed and is_distributed():
+        total = all_reduce_sum(total)
+        scale = dist.get_world_size()
+    if total == 0:
+        return [0.0] * len(window)
+    return [n * scale / total for n in tokens]
+
+
+def count_optimizer_steps(batch_sampler, num_epochs, accumulation_steps):
+    """전체 학습의 optimizer step 수 (CosineAnnealingLR T_max)
+
+    epoch 마다 배치 수가 달라지는 TokenBudgetSampler 도 epoch 별로 계산하고,
+    epoch 끝의 짧은 accumulation 구간도 한 step 으로 센다.
+    """
+    total = 0
+    for epoch in range(num_epochs):
+        if hasattr(batch_sampler, 'num_batches'):
+            num_batches = batch_sampler.num_batches(epoch)
+        else:
+            num_batches = len(batch_sampler)
+        total += math.ceil(num_batches / accumulation_steps)
+    return total
+
+
+def apply_config_overrides(config, overrides):
+    """명령행 key=value 목록으로 config 덮어쓰기 (값은 JSON 으로 해석, 실패하면 문자열)"""
+    for item in overrides or []:
+        key, sep, value = item.partition('=')
+        if not sep or key not in config:
+            raise ValueError(f"알 수 없는 설정: {item!r} (key=value, key: {', '.join(config)})")
+        try:
+            config[key] = json.loads(value)
+        except json.JSONDecodeError:
+            config[key] = value
+    return config
+
+
+# ============================================
+# 메트릭 집계 (동기화 없음)
+# ============================================
+class MetricAccumulator:
+    """가중 평균 메트릭을 device 텐서로 누적
+
+    add() 는 텐서를 detach 해서 device 위에서 더하기만 하므로 CUDA 동기화가
+    없다 (.item() 호출 없음). 가중치는 CPU 에서 이미 알고 있는 값(토큰 수 등)만
+    받는다. compute() 에서 모든 메트릭을 한 번에 CPU 로 가져온다.
+    """
+
+    def __init__(self):
+        self.sums = {}
+        self.weights = {}
+
+    def add(self, name, value, weight=1):
+        """name 에 value × weight 누적 (value: 스칼라 텐서 또는 숫자)"""
+        if torch.is_tensor(value):
+            value = value.detach().float()
+        if name not in self.sums:
+            device = value.device if torch.is_tensor(value) else 'cpu'
+            self.sums[name] = torch.zeros((), dtype=torch.float32, device=device)
+            self.weights[name] = 0.0
+        self.sums[name] += value * weight
+        self.weights[name] += weight
+
+    def compute(self, distributed=False):
+        """{name: 가중 평균} - 여기서 한 번만 동기화
+
+        distributed=True: 모든 rank 의 합계 / 가중치를 더한 전체 평균 (모든 rank 가 호출)
+        """
+        if distributed and is_distributed():
+            return self._compute_all_ranks()
+        if not self.sums:
+            return {}
+        names = list(self.sums)
+        device = self.sums[names[0]].device
+        values = torch.stack([self.sums[name].to(device) for name in names]).tolist()
+        return {name: value / self.weights[name] if self.weights[name] else 0.0
+                for name, value in zip(names, values)}
+
+    def _compute_all_ranks(self):
+        # rank 마다 누적한 메트릭이 다를 수 있어 (배치 없는 rank) 이름부터 합친다
+        names = sorted(set().union(*all_gather_objects(sorted(self.sums))))
+        if not names:
+            return {}
+        device = _comm_device()
+        zero = torch.zeros((), dtype=torch.float32, device=device)
+        totals = torch.stack([self.sums[name].to(device) if name in self.sums else zero for name in names] +
+                             [torch.tensor(float(self.weights.get(name, 0.0)), device=device) for name in names])
+        dist.all_reduce(totals)
+        values = totals.tolist()
+        return {name: total / weight if weight else 0.0
+                for name, total, weight in zip(names, values[:len(names)], values[len(names):])}
+
+    def reset(self):
+        self.sums = {}
+        self.weights = {}
+
+    def state_dict(self):
+        """재개용 (동기화 발생)"""
+        return {name: (float(self.sums[name]), self.weights[name]) for name in self.sums}
+
+    def load_state_dict(self, state, device='cpu'):
+        self.reset()
+        for name, (total, weight) in state.items():
+            self.sums[name] = torch.tensor(total, dtype=torch.float32, device=device)
+            self.weights[name] = weight
+
+
+# ============================================
+# 청크 단위 cross-entropy
+# ============================================
+def _lm_head_loss_sum(lm_head, hidden, targets):
+    logits = lm_head(hidden).float()
+    return F.cross_entropy(logits, targets, reduction='sum')
+
+
+def causal_lm_loss(model, input_ids, labels, attention_mask=None, position_ids=None, chunk_size=None):
+    """응답 토큰 next-token cross-entropy
+
+    chunk_size 가 없으면 기존 model(...).loss 경로. 있으면 decoder 의 마지막
+    hidden state 만 받아 레이블이 있는(-100 아닌) 위치만 골라 chunk_size 개씩
+    LM head + cross-entropy 를 계산한다. batch × seq × vocab logits 를 한 번에
+    만들지 않고, 학습 시에는 청크마다 checkpoint 로 backward 때 logits 를 다시
+    계산해 청크 하나 분량의 logits 만 메모리에 둔다. (logit scaling /
+    softcapping 이 없는 Llama 계열 LM head 기준)
+
+    Returns:
+        응답 토큰 평균 loss (outputs.loss 와 같은 값)
+    """
+    if not chunk_size:
+        loss = model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                     labels=labels).loss
+        # 응답 토큰이 하나도 없는 배치 (잘림으로 전체 마스킹) 는 0/0 = NaN 대신 0 (동기화 없음)
+        return torch.where((labels[:, 1:] != -100).any(), loss, loss.new_zeros(()))
+
+    hidden = model.get_decoder()(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                                 use_cache=False).last_hidden_state
+    shift_labels = labels[:, 1:]
+    keep = shift_labels != -100
+    hidden = hidden[:, :-1][keep]
+    targets = shift_labels[keep]
+    if targets.numel() == 0:
+        return hidden.float().sum() * 0.0  # 그래프 유지
+
+    lm_head = model.get_output_embeddings()
+    total = 0.0
+    for start in range(0, targets.numel(), chunk_size):
+        chunk = (lm_head, hidden[start:start + chunk_size], targets[start:start + chunk_size])
+        if torch.is_grad_enabled():
+            total = total + checkpoint(_lm_head_loss_sum, *chunk, use_reentrant=False)
+        else:
+            total = total + _lm_head_loss_sum(*chunk)
+    return total / targets.numel()
+
+
+# ============================================
+# Optimizer
+# ============================================
+def trainable_parameters(model):
+    """requires_grad 파라미터만 (동결된 기본 모델 가중치 제외)"""
+    return [p for p in model.parameters() if p.requires_grad]
+
+
+def optimizer_param_groups(model, weight_decay):
+    """학습 파라미터를 weight decay / no-decay 그룹으로 분리
+
+    bias 와 norm 계열(1차원 텐서 포함)은 weight decay 를 적용하지 않는다.
+    """
+    decay, no_decay = [], []
+    for name, param in model.named_parameters():
+        if not param.requires_grad:
+            continue
+        if param.ndim < 2 or 'bias' in name or 'norm' in name.lower():
+            no_decay.append(param)
+        else:
+            decay.append(param)
+    groups = [{'params': decay, 'weight_decay': weight_decay},
+              {'params': no_decay, 'weight_decay': 0.0}]
+    return [group for group in groups if group['params']]
+
+
+class CPUOffloadAdamW(torch.optim.AdamW):
+    """optimizer 상태를 CPU (고정 메모리) 에 두는 AdamW
+
+    학습 파라미터마다 fp32 마스터 사본과 gradient 버퍼를 CPU 에 두고
+    exp_avg / exp_avg_sq 도 그 사본 기준으로 CPU 에 만든다. step() 은
+    gradient 를 CPU 로 복사 → CPU 에서 foreach AdamW → 갱신된 값을 GPU
+    파라미터로 복사한다. VRAM 에는 파라미터와 gradient 만 남는다.
+    param_groups / state_dict 는 일반 AdamW 와 같아 스케줄러 / 재개에 그대로 쓴다.
+    """
+
+    def __init__(self, param_groups, **kwargs):
+        pin = torch.cuda.is_available()
+        self.device_params = []
+        self.grad_buffers = []
+        cpu_groups = []
+        for group in param_groups:
+            masters = []
+            for param in group['params']:
+                master = param.detach().to('cpu', torch.float32, copy=True)
+                buffer = torch.zeros_like(master)
+                if pin:
+                    master, buffer = master.pin_memory(), buffer.pin_memory()
+                masters.append(master)
+                self.device_params.append(param)
+                self.grad_buffers.append(buffer)
+            cpu_groups.append({**group, 'params': masters})
+        kwargs.setdefault('foreach', True)
+        super().__init__(cpu_groups, **kwargs)
+        self.master_params = [p for group in self.param_groups for p in group['params']]
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        for param, master, buffer in zip(self.device_params, self.master_params, self.grad_buffers):
+            if param.grad is None:
+                master.grad = None
+            else:
+                buffer.copy_(param.grad, non_blocking=True)
+                master.grad = buffer
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()  # D2H 복사 완료 후 CPU 에서 갱신
+
+        loss = super().step(closure)
+
+        for param, master in zip(self.device_params, self.master_params):
+            if master.grad is not None:
+                param.copy_(master, non_blocking=True)
+        return loss
+
+    def zero_grad(self, set_to_none=True):
+        for param in self.device_params:
+            if set_to_none:
+                param.grad = None
+            elif param.grad is not None:
+                param.grad.zero_()
+
+    def load_state_dict(self, state_dict):
+        """상태 복원 + 마스터 사본을 현재 모델 가중치로 갱신 (가중치를 먼저 불러온 뒤 호출)"""
+        super().load_state_dict(state_dict)
+        with torch.no_grad():
+            for param, master in zip(self.device_params, self.master_params):
+                master.copy_(param)
+
+
+def build_optimizer(model, lr, weight_decay=0.01, betas=(0.9, 0.999), eps=1e-8, offload=False):
+    """학습 파라미터 전용 AdamW
+
+    requires_grad 파라미터만 등록하고 (bias / norm 은 no-decay), 모두 CUDA 에
+    있으면 fused 커널, 아니면 foreach 커널을 쓴다. offload=True 면 optimizer
+    상태를 CPU 고정 메모리에 두는 CPUOffloadAdamW.
+    """
+    groups = optimizer_param_groups(model, weight_decay)
+    if offload:
+        return CPUOffloadAdamW(groups, lr=lr, betas=betas, eps=eps)
+
+    devices = {p.device.type for group in groups for p in group['params']}
+    kernel = {'fused': True} if devices == {'cuda'} else {'foreach': True}
+    return torch.optim.AdamW(groups, lr=lr, betas=betas, eps=eps, **kernel)
+
+
+def optimizer_summary(optimizer):
+    """로그용 한 줄 요약 (종류 / 커널 / 그룹별 파라미터 수)"""
+    if optimizer.defaults.get('fused'):
+        kernel = 'fused'
+    else:
+        kernel = 'foreach' if optimizer.defaults.get('foreach') else 'for-loop'
+    groups = ', '.join(f"wd={g['weight_decay']}: {sum(p.numel() for p in g['params']) / 1e6:.2f}M"
+                       for g in optimizer.param_groups)
+    return f"{type(optimizer).__name__} ({kernel}) [{groups}]"
+
+
+# ============================================
+# 배치 크기 / accumulation 자동 탐색
+# ============================================
+def _is_oom(error):
+    return isinstance(error, torch.cuda.OutOfMemoryError) or 'out of memory' in str(error)
+
+
+def find_batch_size(model, dataset, collate_fn, effective_batch_size, loss_fn, device, max_batch_size=None,
+                    probe_steps=3, memory_fraction=0.9, optimizer_offload=False, seed=42):
+    """메모리 예산 안에서 처리량이 가장 높은 마이크로배치 크기 탐색
+
+    effective_batch_size 의 약수(1, 2, 4, ...)를 작은 것부터 시도한다.
+    1) 가장 긴 샘플 B 개로 forward/backward 한 번 → OOM 이거나 최대 메모리
+       (+ AdamW 상태 추정치)가 GPU 메모리 × memory_fraction 을 넘으면 중단
+    2) 실제 길이 분포(LengthBucketSampler 배치)로 probe_steps 번 forward/backward
+       → 실제 토큰/초 측정
+    통과한 크기 중 토큰/초가 가장 높은 B 를 고르고 accumulation 은
+    effective_batch_size / B 로 정한다 (실효 배치 유지). 가중치는 바꾸지 않고
+    (optimizer step 없음) gradient / RNG 상태는 원래대로 되돌린다.
+    CPU 에서는 메모리 검사 없이 max_batch_size 와 처리량만으로 고른다.
+
+    Args:
+        loss_fn: CPU 배치 → loss 텐서 (device 이동 포함)
+
+    Returns:
+        {'batch_size', 'gradient_accumulation_steps', 'tokens_per_sec', 'probes': [...]}
+    """
+    from hira_dataset import LengthBucketSampler
+
+    lengths = np.asarray(dataset.lengths)
+    limit = min(len(lengths), max_batch_size or effective_batch_size)
+    candidates = [b for b in range(1, effective_batch_size + 1) if effective_batch_size % b == 0 and b <= limit]
+    longest = np.argsort(lengths, kind='stable')[::-1]
+
+    device = torch.device(device)
+    cuda = device.type == 'cuda'
+    budget = torch.cuda.get_device_properties(device).total_memory * memory_fraction if cuda else None
+    state_bytes = 0 if optimizer_offload else 8 * sum(p.numel() for p in trainable_parameters(model))
+    saved_rng = rng_state()
+    was_training = model.training
+    model.train()
+
+    def run(batch):
+        loss_fn(batch).backward()
+        model.zero_grad(set_to_none=True)
+        if cuda:
+            torch.cuda.synchronize(device)
+
+    probes = []
+    for batch_size in candidates:
+        probe = {'batch_size': batch_size}
+        try:
+            if cuda:
+                torch.cuda.empty_cache()
+                torch.cuda.reset_peak_memory_stats(device)
+            run(collate_fn([dataset[int(i)] for i in longest[:batch_size]]))
+            if cuda:
+                peak = torch.cuda.max_memory_allocated(device) + state_bytes
+                probe['peak_memory_mb'] = round(peak / 1024**2, 1)
+                if peak > budget:
+                    probe['status'] = 'over_budget'
+                    probes.append(probe)
+                    break
+
+            sampler = LengthBucketSampler(lengths, batch_size, shuffle=True, seed=seed)
+            batches = [collate_fn([dataset[i] for i in indices]) for indices in sampler._batches()[:probe_steps]]
+            tokens, elapsed = 0, 0.0
+            for batch in batches:
+                start = time.perf_counter()
+                run(batch)
+                elapsed += time.perf_counter() - start
+                tokens += batch_token_counts(batch)[0]
+        except RuntimeError as error:
+            if not _is_oom(error):
+                raise
+            model.zero_grad(set_to_none=True)
+            if cuda:
+                torch.cuda.empty_cache()
+            probe['status'] = 'oom'
+            probes.append(probe)
+            break
+
+        probe['status'] = 'ok'
+        probe['tokens_per_sec'] = round(tokens / elapsed, 1) if elapsed else 0.0
+        probes.append(probe)
+
+    model.train(was_training)
+    set_rng_state(saved_rng)
+    if cuda:
+        torch.cuda.empty_cache()
+
+    fitted = [p for p in probes if p['status'] == 'ok']
+    if not fitted:
+        raise RuntimeError(f"batch_size=1 도 메모리 예산을 넘습니다: {probes}")
+    # 처리량 동률이면 큰 배치 (accumulation 횟수 감소)
+    best = max(fitted, key=lambda p: (p['tokens_per_sec'], p['batch_size']))
+    return {
+        'batch_size': best['batch_size'],
+        'gradient_accumulation_steps': effective_batch_size // best['batch_size'],
+        'tokens_per_sec': best['tokens_per_sec'],
+        'probes': probes,
+    }
+
+
+# ============================================
+# Step 계측
+# ============================================
+def batch_token_counts(batch):
+    """(실제 토큰 수, 샘플 수) - 패딩 제외, packing 행은 포함된 샘플 수"""
+    if 'segment_ids' in batch:
+        real = batch['segment_ids'] >= 0
+        samples = int(((batch['position_ids'] == 0) & real).sum())
+        return int(real.sum()), samples
+    return int(batch['attention_mask'].sum()), batch['input_ids'].shape[0]
+
+
+class StepProfiler:
+    """optimizer step 단위 시간 분해 / 처리량 계측
+
+    interval step 마다 한 번 상세 계측한다: 그 step 에서만 구간 경계마다
+    CUDA 동기화를 해서 GPU 시간을 정확히 나누고, 결과를 JSONL 로 기록한다.
+    나머지 step 은 동기화 없이 토큰/샘플 수와 벽시계 시간만 누적한다.
+
+    사용:
+        for window in accumulation_windows(profiler.timed(loader), n):
+            profiler.start_step()
+            with profiler.phase('forward'): ...
+            profiler.end_step(global_step, epoch)
+    """
+
+    def __init__(self, log_path=None, interval=10, device=None, append=False):
+        # append=True: 학습 재개 시 기존 기록 뒤에 이어 쓰기
+        self.interval = max(int(interval), 1)
+        self.cuda = device is not None and torch.device(device).type == 'cuda'
+        self.writer = JsonlWriter(log_path, append=append, batch_size=1) if log_path else None
+
+        self.steps = 0
+        self.sampled = False
+        self.current = dict.fromkeys(PROFILE_PHASES, 0.0)
+        self.tokens = 0
+        self.samples = 0
+        self.last_end = time.perf_counter()
+
+        # 전체 누적
+        self.total_tokens = 0
+        self.total_samples = 0
+        self.total_time = 0.0
+        self.records = []
+        self.peak_memory = 0
+
+    def _sync(self):
+        if self.sampled and self.cuda:
+            torch.cuda.synchronize()
+
+    def timed(self, iterable):
+        """DataLoader 대기 시간을 재는 이터레이터 래퍼"""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.current['data_wait'] += time.perf_counter() - start
+            yield item
+
+    def start_step(self):
+        self.sampled = (self.steps + 1) % self.interval == 0
+        if self.sampled and self.cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+
+    @contextmanager
+    def phase(self, name):
+        self._sync()
+        start = time.perf_counter()
+        yield
+        self._sync()
+        self.current[name] += time.perf_counter() - start
+
+    def count(self, batch):
+        tokens, samples = batch_token_counts(batch)
+        self.tokens += tokens
+        self.samples += samples
+
+    def end_step(self, global_step, epoch):
+        self._sync()
+        now = time.perf_counter()
+        step_time = now - self.last_end
+        self.last_end = now
+        self.steps += 1
+        self.total_tokens += self.tokens
+        self.total_samples += self.samples
+        self.total_time += step_time
+
+        if self.sampled:
+            record = {
+                'step': global_step,
+                'epoch': epoch,
+                'step_time': step_time,
+                **{f"{name}_time": seconds for name, seconds in self.current.items()},
+                'tokens': self.tokens,
+                'samples': self.samples,
+                'tokens_per_sec': self.tokens / step_time if step_time > 0 else 0.0,
+                'samples_per_sec': self.samples / step_time if step_time > 0 else 0.0,
+                'peak_memory_mb': torch.cuda.max_memory_allocated() / 1024**2 if self.cuda else None,
+            }
+            if record['peak_memory_mb'] is not None:
+                self.peak_memory = max(self.peak_memory, record['peak_memory_mb'])
+            self.records.append(record)
+            if self.writer is not None:
+                self.writer.write(record)
+
+        self.current = dict.fromkeys(PROFILE_PHASES, 0.0)
+        self.tokens = 0
+        self.samples = 0
+        self.sampled = False
+
+    def skip_interval(self):
+        """평가 / 체크포인트 저장처럼 학습이 아닌 시간을 다음 step 에서 제외"""
+        self.last_end = time.perf_counter()
+        self.current['data_wait'] = 0.0
+
+    def summary(self):
+        """전체 처리량 + 계측 step 평균 구간별 시간"""
+        summary = {
+            'steps': self.steps,
+            'sampled_steps': len(self.records),
+            'tokens_per_sec': self.total_tokens / self.total_time if self.total_time else 0.0,
+            'samples_per_sec': self.total_samples / self.total_time if self.total_time else 0.0,
+            'peak_memory_mb': self.peak_memory if self.cuda else None,
+        }
+        if self.records:
+            mean_step = sum(r['step_time'] for r in self.records) / len(self.records)
+            summary['mean_step_time'] = mean_step
+            for name in PROFILE_PHASES:
+                mean = sum(r[f"{name}_time"] for r in self.records) / len(self.records)
+                summary[f"{name}_time"] = mean
+                summary[f"{name}_pct"] = 100 * mean / mean_step if mean_step else 0.0
+        return summary
+
+    def summary_lines(self):
+        """training_log.txt 용 요약"""
+        summary = self.summary()
+        lines = [
+            f"Steps: {summary['steps']} (계측 {summary['sampled_steps']})",
+            f"Tokens/sec: {summary['tokens_per_sec']:.1f}",
+            f"Samples/sec: {summary['samples_per_sec']:.2f}",
+        ]
+        if summary['peak_memory_mb'] is not None:
+            lines.append(f"Peak Memory: {summary['peak_memory_mb']:.0f} MB")
+        if 'mean_step_time' in summary:
+            lines.append(f"Mean Step Time: {summary['mean_step_time'] * 1000:.1f} ms")
+            for name in PROFILE_PHASES:
+                lines.append(f"  {name:10s} {summary[f'{name}_time'] * 1000:9.1f} ms "
+                             f"({summary[f'{name}_pct']:5.1f}%)")
+        return lines
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+# ============================================
+# 비동기 top-K 체크포인트
+# ============================================
+def trainable_state_dict(model):
+    """학습 대상 파라미터만 CPU 로 복사한 state dict
+
+    PEFT 모델은 get_peft_model_state_dict (LoRA + modules_to_save) 를 사용해
+    save_pretrained 와 같은 키를 만든다. 복사본이라 이후 optimizer.step() 과
+    무관하게 백그라운드에서 저장할 수 있다.
+    """
+    if hasattr(model, 'peft_config'):
+        from peft import get_peft_model_state_dict
+        state = get_peft_model_state_dict(model)
+    else:
+        state = {name: p for name, p in model.named_parameters() if p.requires_grad}
+    return {name: tensor.detach().to('cpu', copy=True).contiguous() for name, tensor in state.items()}
+
+
+def save_adapter_config(model, output_dir):
+    """adapter_config.json 저장 (PeftModel.save_pretrained 와 동일하게 inference_mode=True)"""
+    if not hasattr(model, 'peft_config'):
+        return
+    peft_config = model.peft_config[getattr(model, 'active_adapter', 'default')]
+    if peft_config.base_model_name_or_path is None:
+        peft_config.base_model_name_or_path = model.get_base_model().__dict__.get('name_or_path')
+    inference_mode = peft_config.inference_mode
+    peft_config.inference_mode = True
+    try:
+        peft_config.save_pretrained(output_dir)
+    finally:
+        peft_config.inference_mode = inference_mode
+
+
+def _replace_dir(src, dst):
+    """src 디렉토리를 dst 로 교체 (rename 기반)
+
+    dst → dst.old, src → dst 두 번의 rename 사이에서 중단되면 dst.old 만
+    남는다 (load_training_state 가 이 경우 dst.old 로 재개).
+    """
+    dst = Path(dst)
+    if dst.is_symlink() or dst.is_file():
+        dst.unlink()
+    elif dst.exists():
+        old = dst.with_name(dst.name + '.old')
+        if old.exists():
+            shutil.rmtree(old)
+        dst.rename(old)
+        Path(src).rename(dst)
+        shutil.rmtree(old)
+        return
+    Path(src).rename(dst)
+
+
+class AsyncCheckpointer:
+    """val loss 기준 상위 K 개만 남기는 비동기 체크포인트 관리자
+
+    save() 는 학습 파라미터를 CPU 로 복사하고 설정 파일만 쓴 뒤 바로
+    반환한다. safetensors 직렬화, 토크나이저 저장, 임시 디렉토리 → 최종
+    디렉토리 rename, 하위 체크포인트 삭제는 백그라운드 스레드 하나가 순서대로
+    처리한다. best_model 은 현재 최고 체크포인트를 가리키는 심볼릭 링크다
+    (링크를 만들 수 없는 파일시스템에서는 복사).
+
+    top-K 순위는 resume=True 일 때만 기존 checkpoints.json 에서 이어받는다.
+    새 실행이면 같은 디렉토리에 남은 이전 실행의 checkpoint-* / best_model /
+    인덱스를 previous_runs/<시각>/ 으로 옮기고 빈 순위에서 시작한다 (이전 실행
+    체크포인트와 비교되어 새 체크포인트가 지워지거나 best_model 이 옛 가중치를
+    가리키지 않도록).
+    """
+
+    INDEX_FILE = 'checkpoints.json'
+    ARCHIVE_DIR = 'previous_runs'
+
+    def __init__(self, output_dir, save_total_limit=3, tokenizer=None, best_name='best_model', enabled=True,
+                 resume=False):
+        # enabled=False: 저장 호출을 모두 무시 (데이터 병렬의 rank 0 이외 프로세스)
+        self.enabled = enabled
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.save_total_limit = save_total_limit
+        self.tokenizer = tokenizer
+        self.best_name = best_name
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='checkpoint')
+        self.pending = []
+        if not enabled:
+            self.checkpoints = []
+        elif resume:
+            self.checkpoints = self._load_index()
+        else:
+            self._archive_previous_run()
+            self.checkpoints = []
+
+    def _archive_previous_run(self):
+        """이전 실행의 체크포인트 / best_model / 인덱스를 previous_runs/<시각>/ 으로 이동"""
+        leftovers = [path for path in self.output_dir.iterdir()
+                     if path.name in (self.INDEX_FILE, self.best_name) or path.name.startswith('checkpoint-')]
+        if not leftovers:
+            return
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        archive = self.output_dir / self.ARCHIVE_DIR / stamp
+        suffix = 1
+        while archive.exists():
+            archive = archive.with_name(f"{stamp}-{suffix}")
+            suffix += 1
+        archive.mkdir(parents=True)
+        for path in leftovers:
+            # best_model 링크는 같은 디렉토리 안의 상대 경로라 함께 옮기면 그대로 유효
+            path.rename(archive / path.name)
+        print(f"📦 이전 실행 체크포인트 {len(leftovers)}개 항목 → {archive}")
+
+    def _load_index(self):
+        index_path = self.output_dir / self.INDEX_FILE
+        if not index_path.exists():
+            return []
+        with open(index_path, 'r', encoding='utf-8') as f:
+            return [c for c in json.load(f) if (self.output_dir / c['name']).exists()]
+
+    def _write_index(self):
+        tmp_path = self.output_dir / (self.INDEX_FILE + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.checkpoints, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.output_dir / self.INDEX_FILE)
+
+    @property
+    def best(self):
+        return min(self.checkpoints, key=lambda c: c['metric']) if self.checkpoints else None
+
+    def _check_pending(self):
+        """끝난 백그라운드 저장의 예외를 학습 스레드로 전달"""
+        still_running = []
+        for future in self.pending:
+            if future.done():
+                future.result()
+            else:
+                still_running.append(future)
+        self.pending = still_running
+
+    def save(self, model, name, metric=None, step=None):
+        """체크포인트 저장 예약
+
+        Args:
+            name: 디렉토리 이름 (예: checkpoint-1200, final_model)
+            metric: val loss (None 이면 top-K 관리 대상에서 제외 - final_model 등)
+        """
+        if not self.enabled:
+            return None
+        self._check_pending()
+        tmp_dir = self.output_dir / f"{name}.tmp"
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir)
+        tmp_dir.mkdir(parents=True)
+
+        state = trainable_state_dict(model)
+        save_adapter_config(model, tmp_dir)
+
+        future = self.executor.submit(self._write, state, tmp_dir, name, metric, step)
+        self.pending.append(future)
+        return future
+
+    def _write(self, state, tmp_dir, name, metric, step):
+        from safetensors.torch import save_file
+
+        filename = 'adapter_model.safetensors' if (tmp_dir / 'adapter_config.json').exists() else 'model.safetensors'
+        save_file(state, str(tmp_dir / filename), metadata={'format': 'pt'})
+        if self.tokenizer is not None:
+            self.tokenizer.save_pretrained(tmp_dir)
+        _replace_dir(tmp_dir, self.output_dir / name)
+
+        if metric is None:
+            return
+        self.checkpoints = [c for c in self.checkpoints if c['name'] != name]
+        self.checkpoints.append({'name': name, 'metric': metric, 'step': step})
+        self.checkpoints.sort(key=lambda c: c['metric'])
+        for stale in self.checkpoints[self.save_total_limit:]:
+            shutil.rmtree(self.output_dir / stale['name'], ignore_errors=True)
+        self.checkpoints = self.checkpoints[:self.save_total_limit]
+        self._write_index()
+        self._link_best()
+
+    def _link_best(self):
+        best = self.best
+        if best is None:
+            return
+        link = self.output_dir / self.best_name
+        tmp_link = self.output_dir / (self.best_name + '.tmp')
+        try:
+            if tmp_link.is_symlink() or tmp_link.exists():
+                tmp_link.unlink()
+            tmp_link.symlink_to(best['name'], target_is_directory=True)
+            if link.exists() and not link.is_symlink():
+                shutil.rmtree(link)
+            os.replace(tmp_link, link)
+        except OSError:
+            # 심볼릭 링크 미지원 → 복사
+            tmp_copy = self.output_dir / (self.best_name + '.copy')
+            if tmp_copy.exists():
+                shutil.rmtree(tmp_copy)
+            shutil.copytree(self.output_dir / best['name'], tmp_copy)
+            _replace_dir(tmp_copy, link)
+
+    def save_training_state(self, model, name, training_state):
+        """학습 재개용 체크포인트 예약 (top-K 관리 대상 아님)
+
+        가중치는 save() 와 같은 형식, training_state (optimizer / scheduler /
+        카운터 / RNG) 는 CPU 로 복사해 training_state.pt 로 함께 저장한다.
+        """
+        if not self.enabled:
+            return None
+        self._check_pending()
+        tmp_dir = self.output_dir / f"{name}.tmp"
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir)
+        tmp_dir.mkdir(parents=True)
+
+        state = trainable_state_dict(model)
+        save_adapter_config(model, tmp_dir)
+        training_state = _to_cpu(training_state)
+
+        def write():
+            torch.save(training_state, tmp_dir / TRAINING_STATE_FILE)
+            self._write(state, tmp_dir, name, None, None)
+
+        future = self.executor.submit(write)
+        self.pending.append(future)
+        return future
+
+    def wait(self):
+        """예약된 저장이 모두 끝날 때까지 대기 (예외 전달)"""
+        for future in self.pending:
+            future.result()
+        self.pending = []
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+
+# ============================================
+# 학습 재개
+# ============================================
+TRAINING_STATE_FILE = 'training_state.pt'
+
+
+def _to_cpu(obj):
+    """중첩 dict/list 안의 텐서를 CPU 복사본으로 (optimizer state 스냅샷)"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def rng_state():
+    """python / numpy / torch (CPU, CUDA) RNG 상태"""
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def load_training_state(checkpoint_dir, model, optimizer=None, scheduler=None):
+    """save_training_state 로 저장한 체크포인트 복원
+
+    가중치 / optimizer / scheduler 를 제자리에 불러오고, 나머지 학습 상태
+    (카운터, history, RNG, 샘플러 위치 등) dict 를 반환한다. RNG 는 호출자가
+    학습 루프 직전에 set_rng_state 로 복원한다.
+    """
+    from safetensors.torch import load_file
+
+    checkpoint_dir = Path(checkpoint_dir)
+    previous = checkpoint_dir.with_name(checkpoint_dir.name + '.old')
+    if not checkpoint_dir.exists() and previous.exists():
+        # _replace_dir 의 두 rename 사이에서 중단 → 직전에 저장된 상태로 재개
+        print(f"⚠️  {checkpoint_dir} 없음 - 교체 중 중단된 이전 상태 {previous} 에서 재개")
+        checkpoint_dir = previous
+    if (checkpoint_dir / 'adapter_model.safetensors').exists():
+        from peft import set_peft_model_state_dict
+        set_peft_model_state_dict(model, load_file(str(checkpoint_dir / 'adapter_model.safetensors')))
+    else:
+        model.load_state_dict(load_file(str(checkpoint_dir / 'model.safetensors')), strict=False)
+
+    training_state = torch.load(checkpoint_dir / TRAINING_STATE_FILE, map_location='cpu', weights_only=False)
+    if optimizer is not None:
+        optimizer.load_state_dict(training_state.pop('optimizer'))
+    if scheduler is not None:
+        scheduler.load_state_dict(training_state.pop('scheduler'))
+    return training_state
+
+
+# ============================================
+# 데이터 병렬 (torchrun)
+# ============================================
+def init_distributed():
+    """torchrun 환경변수 (RANK / WORLD_SIZE / LOCAL_RANK) 로 프로세스 그룹 초기화
+
+    WORLD_SIZE 가 없거나 1 이면 단일 프로세스 그대로. GPU 가 있으면 nccl +
+    rank 당 GPU 하나, 없으면 gloo + CPU (작은 모델로 GPU 없이 검증).
+
+    Returns:
+        (rank, world_size, device)
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 1, torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+        device, backend = torch.device('cuda', local_rank), 'nccl'
+    else:
+        device, backend = torch.device('cpu'), 'gloo'
+    if not dist.is_initialized():
+        dist.init_process_group(backend)
+    return dist.get_rank(), dist.get_world_size(), device
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def is_main_process():
+    return not is_distributed() or dist.get_rank() == 0
+
+
+def setup_for_distributed(is_main):
+    """rank 0 이외 프로세스의 print 끄기 (print(..., force=True) 는 항상 출력)"""
+    import builtins
+
+    builtin_print = builtins.print
+
+    def print(*args, force=False, **kwargs):
+        if is_main or force:
+            builtin_print(*args, **kwargs)
+
+    builtins.print = print
+
+
+def _comm_device():
+    """collective 용 텐서 위치 (nccl 은 GPU 텐서만 지원)"""
+    if dist.get_backend() == 'nccl':
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def all_reduce_sum(value):
+    """숫자 하나를 모든 rank 합으로"""
+    if not is_distributed():
+        return value
+    tensor = torch.tensor(value, dtype=torch.float64, device=_comm_device())
+    dist.all_reduce(tensor)
+    return type(value)(tensor.item())
+
+
+def all_gather_objects(obj):
+    """rank 별 객체 리스트 (단일 프로세스: [obj])"""
+    if not is_distributed():
+        return [obj]
+    gathered = [None] * dist.get_world_size()
+    dist.all_gather_object(gathered, obj)
+    return gathered
+
+
+def broadcast_object(obj, src=0):
+    """rank src 의 객체를 모든 rank 에 (배치 크기 탐색 결과 등)"""
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src)
+    return objects[0]
+
+
+def broadcast_parameters(params, src=0):
+    """rank src 의 값으로 파라미터 맞추기 (학습 시작 / 재개 직후, 학습 파라미터만)"""
+    if not is_distributed():
+        return
+    with torch.no_grad():
+        for p in params:
+            dist.broadcast(p.data, src)
+
+
+def all_reduce_gradients(params, bucket_size_mb=25):
+    """학습 파라미터 gradient 를 rank 평균으로 (accumulation 구간 끝에 한 번)
+
+    DistributedDataParallel 대신 쓰는 이유:
+    - 구간 안의 마이크로배치 backward 는 통신 없이 로컬 누적만 한다
+      (DDP no_sync 와 같음) → 통신은 optimizer step 마다 한 번
+    - 대상은 LoRA 등 학습 파라미터뿐 (동결된 기본 모델 가중치는 broadcast /
+      all-reduce 하지 않음)
+    - causal_lm_loss(chunk_size) 는 decoder 와 LM head 를 직접 호출하므로
+      DDP forward 훅을 거치지 않는다
+
+    gradient 는 dtype / device 별로 bucket_size_mb 단위로 평탄화해 호출 수를 줄인다.
+    """
+    if not is_distributed():
+        return
+    world_size = dist.get_world_size()
+    bucket_bytes = bucket_size_mb * 1024 ** 2
+    open_buckets, buckets = {}, []
+    for p in params:
+        if p.grad is None:
+            # 모든 rank 의 bucket 구성이 같아야 하므로 grad 없는 파라미터도 0 으로 참여
+            p.grad = torch.zeros_like(p)
+        key = (p.grad.dtype, p.grad.device)
+        if key not in open_buckets or open_buckets[key][1] >= bucket_bytes:
+            open_buckets[key] = [[], 0]
+            buckets.append(open_buckets[key][0])
+        open_buckets[key][0].append(p.grad)
+        open_buckets[key][1] += p.grad.numel() * p.grad.element_size()
+
+    for grads in buckets:
+        flat = torch._utils._flatten_dense_tensors(grads)
+        dist.all_reduce(flat)
+        flat.div_(world_size)
+        for grad, synced in zip(grads, torch._utils._unflatten_dense_tensors(flat, grads)):
+            grad.copy_(synced)
+
+
+def synchronized_windows(windows):
+    """rank 마다 배치 수가 다를 수 있는 입력 (streaming) 을 모든 rank 같은 구간 수로
+
+    구간마다 rank 최소 길이로 자르고, 어느 한 rank 라도 데이터가 끝나면 모두
+    멈춘다 (남은 rank 만 all-reduce 를 기다리며 멈추는 것 방지).
+    """
+    if not is_distributed():
+        yield from windows
+        return
+    windows = iter(windows)
+    while True:
+        window = next(windows, [])
+        size = torch.tensor(len(window), device=_comm_device())
+        dist.all_reduce(size, op=dist.ReduceOp.MIN)
+        size = int(size)
+        if size == 0:
+            return
+        yield window[:size]
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.barrier()
+        dist.destroy_process_group()